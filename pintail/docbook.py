@@ -50,8 +50,6 @@ class DocBookPage(pintail.site.Page):
     for tracking and search purposes.
     """
 
-    _html_transform = None
-
     def __init__(self, source, filename):
         self.pbdoctype = None
         self.pbbrand = None
@@ -121,6 +119,13 @@ class DocBookPage(pintail.site.Page):
         return self._tree
 
 
+    def release_translations(self):
+        """
+        Free the translated documents this page has kept loaded.
+        """
+        self._langtrees = {}
+
+
     @property
     def page_id(self):
         """
@@ -212,8 +217,8 @@ class DocBookPage(pintail.site.Page):
         while parent is not None:
             depth += 1
             parent = parent.getparent()
+        ret = []
         def _accumulate_text(node):
-            ret = ''
             for child in node:
                 if not isinstance(child.tag, str):
                     continue
@@ -221,11 +226,11 @@ class DocBookPage(pintail.site.Page):
                     continue
                 if depth < self.maxdepth and child.tag in DOCBOOK_CHUNKS:
                     continue
-                ret += child.text or ''
-                ret += _accumulate_text(child)
-                ret += child.tail or ''
-            return ret
-        return _accumulate_text(node)
+                ret.append(child.text or '')
+                _accumulate_text(child)
+                ret.append(child.tail or '')
+        _accumulate_text(node)
+        return ''.join(ret)
 
 
     def get_content(self, hint=None, lang=None):
@@ -281,7 +286,7 @@ class DocBookPage(pintail.site.Page):
         # in a way that lets you write non-well-formed XML that can't be read by any
         # other tool. Pintail can pretend to be Publican.
         pbdir = os.path.join(self.directory.get_stage_path(), '__publican__')
-        pintail.site.Site._makedirs(pbdir)
+        self.site._ensure_dirs(pbdir)
 
         # Look for the publican.cfg file and extract some values from it.
         cfgdir = self.source.get_source_path()
@@ -322,7 +327,7 @@ class DocBookPage(pintail.site.Page):
         # found a brand and language in publican.cfg.
         if self.pbbrand is not None and self.pblang is not None:
             ccdir = os.path.join(pbdir, 'Common_Content')
-            pintail.site.Site._makedirs(ccdir)
+            self.site._ensure_dirs(ccdir)
             branddir = os.path.join('/usr/share/publican/Common_Content/', self.pbbrand, self.pblang)
             commondir = os.path.join('/usr/share/publican/Common_Content/common/', self.pblang)
             brandfiles = [os.path.join(branddir, xml) for xml in os.listdir(branddir)]
@@ -356,7 +361,7 @@ class DocBookPage(pintail.site.Page):
         `publican_doctype` config option, this method will do various
         things to the document to try to emulate Publican.
         """
-        pintail.site.Site._makedirs(self.directory.get_stage_path())
+        self.site._ensure_dirs(self.directory.get_stage_path())
         self.pbdoctype = self.site.config.get('publican_doctype', self.source.name)
         if self.pbdoctype is not None:
             self._stage_page_publican()
@@ -374,7 +379,7 @@ class DocBookPage(pintail.site.Page):
         """
         ret = None
         try:
-            ret = etree.Element(PINTAIL_NS + 'external')
+            ret = etree.Element(PINTAIL_NS + 'external', nsmap=pintail.site.CACHE_NSMAP)
             ret.set('id', self.directory.path + 'index')
             ret.set(SITE_NS + 'dir', self.directory.path)
             dbfile = self._get_tree(lang)
@@ -418,15 +423,12 @@ class DocBookPage(pintail.site.Page):
         else:
             self.site.log('HTML', lang + ' ' + self.site_id)
 
-        if DocBookPage._html_transform is None:
-            DocBookPage._html_transform = etree.XSLT(etree.parse(os.path.join(self.site.tools_path,
-                                                                              'pintail-html-docbook-local.xsl')))
+        transform = self.site.get_compiled_xsl('pintail-html-docbook-local.xsl')
         args = {}
         args['pintail.format'] = etree.XSLT.strparam('docbook')
-        for pair in pintail.site.XslProvider.get_all_xsl_params('html', self, lang=lang):
-            args[pair[0]] = etree.XSLT.strparam(pair[1])
+        args.update(pintail.site.XslProvider.get_xsl_params_dict('html', self, lang=lang))
         tree = self._get_tree(lang)
-        DocBookPage._html_transform(tree, **args)
+        transform(tree, **args)
 
         return
         # Leaving in this code to call xsltproc for now. It turns out that using
@@ -460,7 +462,7 @@ class DocBookPage(pintail.site.Page):
         `publican_doctype` config option.
         """
         refs = set()
-        def _accumulate_refs(node):
+        for node in self._tree.iter(etree.Element):
             src = node.get('fileref', None)
             if src is not None and ':' not in src:
                 refs.add(src)
@@ -471,9 +473,6 @@ class DocBookPage(pintail.site.Page):
                 href = node.get('url', None)
                 if href is not None and ':' not in href:
                     refs.add(href)
-            for child in node:
-                _accumulate_refs(child)
-        _accumulate_refs(self._tree.getroot())
 
         # If files don't exist, but Publican provides them, stage them.
         if self.pbbrand is not None and self.pblang is not None:
@@ -490,13 +489,13 @@ class DocBookPage(pintail.site.Page):
                 tryref = os.path.join('/usr/share/publican/Common_Content/', self.pbbrand, self.pblang, rref)
                 if os.path.exists(tryref):
                     self.site.log('STAGE', self.directory.path + ref)
-                    pintail.site.Site._makedirs(os.path.dirname(stagepath))
+                    self.site._ensure_dirs(os.path.dirname(stagepath))
                     shutil.copyfile(tryref, stagepath)
                     continue
                 tryref = os.path.join('/usr/share/publican/Common_Content/common/', self.pblang, rref)
                 if os.path.exists(tryref):
                     self.site.log('STAGE', self.directory.path + ref)
-                    pintail.site.Site._makedirs(os.path.dirname(stagepath))
+                    self.site._ensure_dirs(os.path.dirname(stagepath))
                     shutil.copyfile(tryref, stagepath)
 
         return refs
@@ -646,7 +645,7 @@ class DocBookTools(pintail.site.ToolsProvider, pintail.site.CssProvider):
         """
         xslpath = os.path.join(site.yelp_xsl_path, 'xslt')
 
-        pintail.site.Site._makedirs(site.tools_path)
+        site._ensure_dirs(site.tools_path)
         cssxsl = os.path.join(site.tools_path, 'pintail-css-docbook.xsl')
         fd = open(cssxsl, 'w')
         fd.writelines([
@@ -692,7 +691,7 @@ class DocBookTools(pintail.site.ToolsProvider, pintail.site.CssProvider):
             ])
         fd.close()
 
-        seenlangs = []
+        seenlangs = set()
         for page in site.root.iter_pages():
             if not isinstance(page, DocBookPage):
                 continue
@@ -704,7 +703,7 @@ class DocBookTools(pintail.site.ToolsProvider, pintail.site.CssProvider):
                     continue
                 if lang in seenlangs:
                     continue
-                seenlangs.append(lang)
+                seenlangs.add(lang)
                 cssfile = 'pintail-docbook-' + lang + '.css'
                 csspath = os.path.join(site.target_path, cssfile)
                 site.log('CSS', '/' + cssfile)
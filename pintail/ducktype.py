@@ -44,7 +44,7 @@ class DucktypePage(pintail.mallard.MallardPage):
         """
         Create a Mallard XML file in the stage.
         """
-        pintail.site.Site._makedirs(self.directory.get_stage_path())
+        self.site._ensure_dirs(self.directory.get_stage_path())
         subprocess.call(['ducktype',
                          '-o', self.get_stage_path(),
                          self.get_source_path()])
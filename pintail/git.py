@@ -56,7 +56,7 @@ class GitSource(pintail.site.Source, pintail.site.XslProvider):
                     self.site.warn('Failed to update git repository')
         else:
             self.site.log('CLONE', self.repo + '@' + self.branch)
-            pintail.site.Site._makedirs(os.path.join(self.site.pindir, 'git'))
+            self.site._ensure_dirs(os.path.join(self.site.pindir, 'git'))
             p = subprocess.Popen(['git', 'clone', '-q', '--depth', '1',
                                   '-b', self.branch, '--single-branch',
                                   self.repo, self.repodir],
@@ -17,6 +17,7 @@
 import copy
 import os
 import subprocess
+import threading
 
 from lxml import etree
 
@@ -31,13 +32,37 @@ NS_MAP = {
     'cache': 'http://projectmallard.org/cache/1.0/'
 }
 
+MAL_PAGE = MAL_NS + 'page'
+MAL_INFO = MAL_NS + 'info'
+MAL_LINK = MAL_NS + 'link'
+MAL_TITLE = MAL_NS + 'title'
+MAL_SECTION = MAL_NS + 'section'
+
+# Compiled once here, rather than on every call for every page.
+XPATH_TITLE_SEARCH = etree.XPath('/mal:page/mal:info/mal:title[@type="search"]',
+                                 namespaces=NS_MAP)
+XPATH_TITLE_TEXT_SEARCH = etree.XPath('/mal:page/mal:info/mal:title[@type="text"][@role="search"]',
+                                      namespaces=NS_MAP)
+XPATH_TITLE_TEXT = etree.XPath('/mal:page/mal:info/mal:title[@type="text"][not(@role)]',
+                               namespaces=NS_MAP)
+XPATH_TITLE = etree.XPath('/mal:page/mal:title', namespaces=NS_MAP)
+XPATH_DESC_SEARCH = etree.XPath('/mal:page/mal:info/mal:desc[@type="search"]',
+                                namespaces=NS_MAP)
+XPATH_DESC_TEXT_SEARCH = etree.XPath('/mal:page/mal:info/mal:desc[@type="text"][@role="search"]',
+                                     namespaces=NS_MAP)
+XPATH_DESC_TEXT = etree.XPath('/mal:page/mal:info/mal:desc[@type="text"][not(@role)]',
+                              namespaces=NS_MAP)
+XPATH_DESC = etree.XPath('/mal:page/mal:info/mal:desc[not(@type)]', namespaces=NS_MAP)
+XPATH_KEYWORDS = etree.XPath('/mal:page/mal:info/mal:keywords', namespaces=NS_MAP)
+XPATH_STRING = etree.XPath('string(.)')
+
 class MallardPage(pintail.site.Page):
     """
     An individual Mallard page in a directory.
     """
 
-    _html_transform = None
     _stack_transforms = {}
+    _stack_lock = threading.Lock()
 
     def __init__(self, source, filename):
         super().__init__(source, filename)
@@ -56,11 +81,19 @@ class MallardPage(pintail.site.Page):
         if lang in self._langtrees:
             return self._langtrees[lang]
         if self.site.translate_page(self, lang):
-            return etree.parse(self.get_stage_path(lang))
+            self._langtrees[lang] = etree.parse(self.get_stage_path(lang))
+            return self._langtrees[lang]
         self._notlangs.add(lang)
         return self._tree
 
 
+    def release_translations(self):
+        """
+        Free the translated documents this page has kept loaded.
+        """
+        self._langtrees = {}
+
+
     @property
     def page_id(self):
         """
@@ -84,7 +117,7 @@ class MallardPage(pintail.site.Page):
         """
         Create a Mallard file in the stage.
         """
-        pintail.site.Site._makedirs(self.directory.get_stage_path())
+        self.site._ensure_dirs(self.directory.get_stage_path())
         subprocess.call(['xmllint', '--xinclude',
                          '-o', self.get_stage_path(),
                          self.get_source_path()])
@@ -95,23 +128,26 @@ class MallardPage(pintail.site.Page):
         Get XML data to add to the cache, as an lxml.etree.Element object.
         """
         def _get_node_cache(node):
-            ret = etree.Element(node.tag)
+            if node.tag == MAL_PAGE:
+                ret = etree.Element(node.tag, nsmap=pintail.site.CACHE_NSMAP)
+            else:
+                ret = etree.Element(node.tag)
             ret.text = '\n'
             ret.tail = '\n'
             for attr in node.keys():
                 if attr != 'id':
                     ret.set(attr, node.get(attr))
-            if node.tag == MAL_NS + 'page':
+            if node.tag == MAL_PAGE:
                 ret.set('id', self.site_id)
             elif node.get('id', None) is not None:
                 ret.set('id', self.site_id + '#' + node.get('id'))
             ret.set(SITE_NS + 'dir', self.directory.path)
             for child in node:
-                if child.tag == MAL_NS + 'info':
+                if child.tag == MAL_INFO:
                     info = etree.Element(child.tag)
                     ret.append(info)
                     for infochild in child:
-                        if infochild.tag == MAL_NS + 'link':
+                        if infochild.tag == MAL_LINK:
                             xref = infochild.get('xref', None)
                             if xref is None or xref.startswith('/'):
                                 info.append(copy.deepcopy(infochild))
@@ -126,9 +162,9 @@ class MallardPage(pintail.site.Page):
                                 info.append(copy.deepcopy(link))
                         else:
                             info.append(copy.deepcopy(infochild))
-                if child.tag == MAL_NS + 'title':
+                if child.tag == MAL_TITLE:
                     ret.append(copy.deepcopy(child))
-                elif child.tag == MAL_NS + 'section':
+                elif child.tag == MAL_SECTION:
                     ret.append(_get_node_cache(child))
             return ret
         page = _get_node_cache(self._get_tree(lang).getroot())
@@ -142,10 +178,11 @@ class MallardPage(pintail.site.Page):
         """
         usestacks = (self.site.config.get('mallard_stack_dirs') == 'True')
         if usestacks:
-            MallardPage._stack_transforms.setdefault(self.directory, set())
-            if lang in MallardPage._stack_transforms[self.directory]:
-                return
-            MallardPage._stack_transforms[self.directory].add(lang)
+            with MallardPage._stack_lock:
+                langs = MallardPage._stack_transforms.setdefault(self.directory, set())
+                if lang in langs:
+                    return
+                langs.add(lang)
             logid = self.directory.path
         else:
             logid = self.site_id
@@ -153,13 +190,10 @@ class MallardPage(pintail.site.Page):
             logid = lang + ' ' + logid
         self.site.log('HTML', logid)
 
-        if MallardPage._html_transform is None:
-            MallardPage._html_transform = etree.XSLT(etree.parse(os.path.join(self.site.tools_path,
-                                                                              'pintail-html-mallard-local.xsl')))
+        transform = self.site.get_compiled_xsl('pintail-html-mallard-local.xsl')
         args = {}
         args['pintail.format'] = etree.XSLT.strparam('mallard')
-        for pair in pintail.site.XslProvider.get_all_xsl_params('html', self, lang=lang):
-            args[pair[0]] = etree.XSLT.strparam(pair[1])
+        args.update(pintail.site.XslProvider.get_xsl_params_dict('html', self, lang=lang))
 
         if usestacks:
             pages = [page for page in self.directory.pages if isinstance(page, MallardPage)]
@@ -168,17 +202,20 @@ class MallardPage(pintail.site.Page):
                 sfile.write('<stack xmlns="http://projectmallard.org/1.0/"')
                 sfile.write(' xmlns:xi="http://www.w3.org/2001/XInclude">')
                 for page in pages:
-                    if lang is not None and self.site.translate_page(page, lang):
+                    # The cache build has already translated and parsed each
+                    # page, so ask the page's tree cache rather than running
+                    # the translation again.
+                    if lang is not None and page._get_tree(lang) is not page._tree:
                         sfile.write('<xi:include href="' + page.get_stage_path(lang) + '"/>')
                     else:
                         sfile.write('<xi:include href="' + page.get_stage_path() + '"/>')
                 sfile.write('</stack>')
             stree = etree.parse(spath)
             etree.XInclude()(stree.getroot())
-            MallardPage._html_transform(stree, **args)
+            transform(stree, **args)
             # FIXME but also some params need to become attrs on the cache
         else:
-            MallardPage._html_transform(self._get_tree(lang), **args)
+            transform(self._get_tree(lang), **args)
 
 
     def get_media(self):
@@ -189,16 +226,13 @@ class MallardPage(pintail.site.Page):
         `src` or `href` attributes.
         """
         refs = set()
-        def _accumulate_refs(node):
+        for node in self._tree.iter(etree.Element):
             src = node.get('src', None)
             if src is not None and ':' not in src and src != '#':
                 refs.add(src)
             href = node.get('href', None)
             if href is not None and ':' not in href:
                 refs.add(href)
-            for child in node:
-                _accumulate_refs(child)
-        _accumulate_refs(self._tree.getroot())
         return refs
 
 
@@ -212,20 +246,17 @@ class MallardPage(pintail.site.Page):
         tree = self._get_tree(lang)
         res = []
         if hint == 'search':
-            res = tree.xpath('/mal:page/mal:info/mal:title[@type="search"]',
-                             namespaces=NS_MAP)
+            res = XPATH_TITLE_SEARCH(tree)
             if len(res) == 0:
-                res = tree.xpath('/mal:page/mal:info/mal:title[@type="text"][@role="search"]',
-                                 namespaces=NS_MAP)
+                res = XPATH_TITLE_TEXT_SEARCH(tree)
         if len(res) == 0:
-            res = tree.xpath('/mal:page/mal:info/mal:title[@type="text"][not(@role)]',
-                             namespaces=NS_MAP)
+            res = XPATH_TITLE_TEXT(tree)
         if len(res) == 0:
-            res = tree.xpath('/mal:page/mal:title', namespaces=NS_MAP)
+            res = XPATH_TITLE(tree)
         if len(res) == 0:
             return ''
         else:
-            return res[-1].xpath('string(.)')
+            return XPATH_STRING(res[-1])
 
 
     def get_desc(self, hint=None, lang=None):
@@ -238,20 +269,17 @@ class MallardPage(pintail.site.Page):
         tree = self._get_tree(lang)
         res = []
         if hint == 'search':
-            res = tree.xpath('/mal:page/mal:info/mal:desc[@type="search"]',
-                             namespaces=NS_MAP)
+            res = XPATH_DESC_SEARCH(tree)
             if len(res) == 0:
-                res = tree.xpath('/mal:page/mal:info/mal:desc[@type="text"][@role="search"]',
-                                 namespaces=NS_MAP)
+                res = XPATH_DESC_TEXT_SEARCH(tree)
         if len(res) == 0:
-            res = tree.xpath('/mal:page/mal:info/mal:desc[@type="text"][not(@role)]',
-                             namespaces=NS_MAP)
+            res = XPATH_DESC_TEXT(tree)
         if len(res) == 0:
-            res = tree.xpath('/mal:page/mal:info/mal:desc[not(@type)]', namespaces=NS_MAP)
+            res = XPATH_DESC(tree)
         if len(res) == 0:
             return ''
         else:
-            return res[-1].xpath('string(.)')
+            return XPATH_STRING(res[-1])
 
 
     def get_keywords(self, hint=None, lang=None):
@@ -262,11 +290,11 @@ class MallardPage(pintail.site.Page):
         which is expected to be finalized in Mallard 1.2.
         """
         tree = self._get_tree(lang)
-        res = tree.xpath('/mal:page/mal:info/mal:keywords', namespaces=NS_MAP)
+        res = XPATH_KEYWORDS(tree)
         if len(res) == 0:
             return ''
         else:
-            return res[-1].xpath('string(.)')
+            return XPATH_STRING(res[-1])
 
 
     def get_content(self, hint=None, lang=None):
@@ -277,18 +305,20 @@ class MallardPage(pintail.site.Page):
         # processing, correct block fallback. Probably should just have a mal2text
         # in yelp-xsl.
         tree = self._get_tree(lang)
+        # Collect pieces and join them once at the end. Concatenating
+        # strings up the tree copies the text over and over on big pages.
+        ret = []
         def _accumulate_text(node):
-            ret = ''
             for child in node:
                 if not isinstance(child.tag, str):
                     continue
-                if node.tag == MAL_NS + 'info':
+                if node.tag == MAL_INFO:
                     continue
-                ret += child.text or ''
-                ret += _accumulate_text(child)
-                ret += child.tail or ''
-            return ret
-        return _accumulate_text(tree.getroot())
+                ret.append(child.text or '')
+                _accumulate_text(child)
+                ret.append(child.tail or '')
+        _accumulate_text(tree.getroot())
+        return ''.join(ret)
 
 
     @classmethod
@@ -363,7 +393,7 @@ class MallardTools(pintail.site.ToolsProvider,
         """
         xslpath = os.path.join(site.yelp_xsl_path, 'xslt')
 
-        pintail.site.Site._makedirs(site.tools_path)
+        site._ensure_dirs(site.tools_path)
         cssxsl = os.path.join(site.tools_path, 'pintail-css-mallard.xsl')
         fd = open(cssxsl, 'w')
         fd.writelines([
@@ -411,14 +441,14 @@ class MallardTools(pintail.site.ToolsProvider,
             ])
         fd.close()
 
-        seenlangs = []
+        seenlangs = set()
         for lang in [None] + site.get_langs():
             cache = site.get_cache_path(lang)
             for page in etree.parse(cache).xpath('/cache:cache/mal:page', namespaces=NS_MAP):
                 lang = page.get(XML_NS + 'lang', 'C')
                 if lang in seenlangs:
                     continue
-                seenlangs.append(lang)
+                seenlangs.add(lang)
                 cssfile = 'pintail-mallard-' + lang + '.css'
                 csspath = os.path.join(site.target_path, cssfile)
                 site.log('CSS', '/' + cssfile)
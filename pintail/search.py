@@ -28,9 +28,12 @@ class SearchProvider(pintail.site.Extendable):
         Build the search index for the site.
 
         This method calls `index_directory` on each directory in the site.
+        On filtered builds, it skips subtrees that can't contain anything
+        that meets the filter.
         Search providers probably do not need to override this method.
+        If they do, they can use `Directory.iter_filtered_directories` to do the same.
         """
-        for subdir in self.site.root.iter_directories():
+        for subdir in self.site.root.iter_filtered_directories():
             self.index_directory(subdir)
 
     def index_directory(self, directory):
@@ -43,11 +46,9 @@ class SearchProvider(pintail.site.Extendable):
         the translation provider for the directory.
         Search providers probably do not need to override this method.
         """
-        langs = [None]
         if not self.site.get_filter(directory):
             return
-        if self.site.translation_provider is not None:
-            langs += self.site.translation_provider.get_directory_langs(directory)
+        langs = [None] + directory.get_langs()
         for page in directory.pages:
             if not self.site.get_filter(page):
                 continue
@@ -14,19 +14,25 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import codecs
+import concurrent.futures
 import configparser
+import contextlib
 import copy
 import datetime
+import fnmatch
+import functools
 import glob
 import importlib
 import logging
 import os
+import re
 import shutil
 import subprocess
 import sys
+import threading
 
 from lxml import etree
+from lxml.builder import ElementMaker
 
 MAL_NS = '{http://projectmallard.org/1.0/}'
 CACHE_NS = '{http://projectmallard.org/cache/1.0/}'
@@ -36,6 +42,50 @@ NS_MAP = {
     'mal': 'http://projectmallard.org/1.0/',
     'cache': 'http://projectmallard.org/cache/1.0/'
 }
+# Namespace prefixes used in the cache file.
+CACHE_NSMAP = {
+    None: 'http://projectmallard.org/1.0/',
+    'cache': 'http://projectmallard.org/cache/1.0/',
+    'site': 'http://projectmallard.org/site/1.0/',
+    'pintail': 'http://pintail.io/'
+}
+XSL = ElementMaker(namespace='http://www.w3.org/1999/XSL/Transform',
+                   nsmap={'xsl': 'http://www.w3.org/1999/XSL/Transform'})
+
+_resources = {}
+
+
+def _get_resource(name):
+    # The same few packaged files are written out by init, build_tools,
+    # and the feed setup, so read each one once and keep its bytes.
+    if name not in _resources:
+        # pintail is a namespace package, so look next to this module rather
+        # than in whichever pintail directory was imported first.
+        with open(os.path.join(os.path.dirname(__file__), name), 'rb') as fd:
+            _resources[name] = fd.read()
+    return _resources[name]
+
+
+def _write_cache_data(xf, elem, nsmap=CACHE_NSMAP):
+    # lxml's xmlfile declares every namespace in scope again on each element
+    # passed to write, which would repeat the cache's declarations on every
+    # page. Write elements with xf.element instead, which knows what the
+    # enclosing elements declared, and only declare namespaces that are new.
+    if isinstance(elem.tag, str):
+        newns = {prefix: uri for prefix, uri in elem.nsmap.items()
+                 if nsmap.get(prefix) != uri}
+        if newns:
+            nsmap = dict(nsmap)
+            nsmap.update(newns)
+        with xf.element(elem.tag, elem.attrib, nsmap=newns):
+            if elem.text:
+                xf.write(elem.text)
+            for child in elem:
+                _write_cache_data(xf, child, nsmap)
+    else:
+        xf.write(elem, with_tail=False)
+    if elem.tail:
+        xf.write(elem.tail)
 
 
 class DuplicatePageException(Exception):
@@ -48,6 +98,28 @@ class Extendable:
     """
     The base class for all plugins in Pintail.
     """
+
+    # Empty, so classes that declare their own slots don't get a __dict__
+    # from here. Classes that don't declare slots are unaffected.
+    __slots__ = ()
+
+    # Each class keeps a list of its direct subclasses, in the order they
+    # were defined. Flattened results of iter_subclasses are cached, keyed
+    # on (class, filter). Plugins are only defined at import time, so the
+    # cache is cleared whenever a new subclass shows up and otherwise stays
+    # valid for the whole build.
+    _registry_direct = []
+    _subclass_cache = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._registry_direct = []
+        for base in cls.__bases__:
+            if issubclass(base, Extendable):
+                base._registry_direct.append(cls)
+        Extendable._subclass_cache.clear()
+
+
     @classmethod
     def iter_subclasses(cls, filter=None):
         """
@@ -58,10 +130,20 @@ class Extendable:
         A class will only be yielded if it defines that function explicitly,
         rather than inherits it from a parent class.
         """
-        for cls in cls.__subclasses__():
-            if filter is None or filter in cls.__dict__:
-                yield cls
-            yield from cls.iter_subclasses(filter)
+        key = (cls, filter)
+        subclasses = Extendable._subclass_cache.get(key)
+        if subclasses is None:
+            subclasses = tuple(cls._collect_subclasses(filter))
+            Extendable._subclass_cache[key] = subclasses
+        return iter(subclasses)
+
+
+    @classmethod
+    def _collect_subclasses(cls, filter):
+        for subcls in cls._registry_direct:
+            if filter is None or filter in subcls.__dict__:
+                yield subcls
+            yield from subcls._collect_subclasses(filter)
 
 
 class ToolsProvider(Extendable):
@@ -159,37 +241,75 @@ class XslProvider(Extendable):
         It is usually an instance of a `Page` subclass, but it could be something
         else. Always check `obj` before making assumptions.
         """
+        ret = []
+        if hasattr(obj, 'site') and hasattr(obj, 'directory'):
+            # Most params are the same for every page in a directory,
+            # so only work them out once per directory and language.
+            key = (output, obj.directory.path, lang)
+            common = obj.site._xsl_params_cache.get(key)
+            if common is None:
+                common = XslProvider._get_common_xsl_params(output, obj, lang)
+                obj.site._xsl_params_cache[key] = common
+            ret.extend(common)
+        else:
+            ret.extend(XslProvider._get_common_xsl_params(output, obj, lang))
+        if hasattr(obj, 'source_file'):
+            ret.append(('pintail.source.file', obj.source_file))
+        if hasattr(obj, 'site'):
+            ret.append(('pintail.date', obj.site._build_date))
+            ret.append(('pintail.time', obj.site._build_time))
+        else:
+            now = datetime.datetime.now()
+            ret.append(('pintail.date', now.strftime('%Y-%m-%d')))
+            ret.append(('pintail.time', now.strftime('%T')))
+        if hasattr(obj, 'site'):
+            providers = obj.site._xsl_param_providers
+        else:
+            providers = XslProvider.iter_subclasses('get_xsl_params')
+        for c in providers:
+            ret.extend(c.get_xsl_params(output, obj, lang))
+        return ret
+
+
+    @classmethod
+    def _get_common_xsl_params(cls, output, obj, lang):
         ret = []
         if output == 'html' and hasattr(obj, 'site'):
-            html_extension = obj.site.config.get('html_extension') or '.html'
+            html_extension = obj.site._html_extension
             if lang is None:
                 ret.append(('html.extension', '.html'))
             else:
                 ret.append(('html.extension', '.html.' + lang))
-            link_extension = obj.site.config.get('link_extension') or html_extension
+            link_extension = obj.site._link_extension or html_extension
             ret.append(('pintail.extension.link', link_extension))
         if hasattr(obj, 'site'):
             ret.append(('mal.cache.file', obj.site.get_cache_path(lang)))
             if hasattr(obj, 'directory'):
-                ret.append(('pintail.site.root', obj.site.config.get_site_root(obj.directory.path)))
+                ret.append(('pintail.site.root', obj.directory._site_root))
             elif isinstance(obj, Directory):
-                ret.append(('pintail.site.root', obj.site.config.get_site_root(obj.path)))
+                ret.append(('pintail.site.root', obj._site_root))
             else:
                 ret.append(('pintail.site.root', obj.site.config.get_site_root()))
         if hasattr(obj, 'directory'):
             ret.append(('pintail.site.dir', obj.directory.path))
             if output == 'html':
                 ret.append(('html.output.prefix', obj.directory.get_target_path(lang)))
-        if hasattr(obj, 'source_file'):
-            ret.append(('pintail.source.file', obj.source_file))
-        now = datetime.datetime.now()
-        ret.append(('pintail.date', now.strftime('%Y-%m-%d')))
-        ret.append(('pintail.time', now.strftime('%T')))
-        for c in XslProvider.iter_subclasses('get_xsl_params'):
-            ret.extend(c.get_xsl_params(output, obj, lang))
         return ret
 
 
+    @classmethod
+    def get_xsl_params_dict(cls, output, obj, lang=None):
+        """
+        Get all XSLT params for a transform target as keyword arguments.
+
+        This method returns the same params as `get_all_xsl_params`, but as a
+        dictionary of quoted string params that can be passed directly as
+        keyword arguments to an `lxml.etree.XSLT` object.
+        """
+        return {pair[0]: etree.XSLT.strparam(pair[1])
+                for pair in cls.get_all_xsl_params(output, obj, lang=lang)}
+
+
     @classmethod
     def get_xsltproc_args(cls, output, obj, lang=None):
         # Drop this function in the future if we decide to keep DocBook using
@@ -220,6 +340,12 @@ class Page(Extendable):
     and for all translations.
     """
 
+    # Sites can have a great many pages, so keep the common attributes in
+    # slots. Page still has a __dict__ for cached properties and for the
+    # attributes subclasses add.
+    __slots__ = ('source', 'directory', 'site', '_source_file', '_search_domains',
+                 '__dict__')
+
     def __init__(self, source, filename):
         self.source = source
         self.directory = source.directory
@@ -241,7 +367,7 @@ class Page(Extendable):
         return None
 
 
-    @property
+    @functools.cached_property
     def site_id(self):
         """
         The fully qualified site id of the page.
@@ -252,7 +378,7 @@ class Page(Extendable):
         return self.directory.path + self.page_id
 
 
-    @property
+    @functools.cached_property
     def site_path(self):
         """
         The full absolute path to the file in the site.
@@ -261,11 +387,10 @@ class Page(Extendable):
         It includes the directory path as well as the site root.
         It also includes the link extension.
         """
-        root = self.site.config.get_site_root(self.directory.path)
-        ext = self.site.config.get('link_extension')
+        ext = self.site._link_extension
         if ext is None:
-            ext = self.site.config.get('html_extension') or '.html'
-        return root + self.site_id[1:] + ext
+            ext = self.site._html_extension
+        return self.directory._site_root + self.site_id[1:] + ext
 
 
     @property
@@ -283,7 +408,7 @@ class Page(Extendable):
         return os.path.join(self.source.get_source_path(), self.source_file)
 
 
-    @property
+    @functools.cached_property
     def stage_file(self):
         """
         The name of the staged file for this page.
@@ -295,10 +420,10 @@ class Page(Extendable):
         """
         The absolute path to the staged file for this page.
         """
-        return os.path.join(self.directory.get_stage_path(lang), self.stage_file)
+        return self.directory.get_stage_path(lang) + self.stage_file
 
 
-    @property
+    @functools.cached_property
     def target_file(self):
         """
         The name of the target file for this page.
@@ -316,12 +441,12 @@ class Page(Extendable):
         return self.site.get_page_target_path(self, lang)
 
 
-    @property
+    @functools.cached_property
     def target_extension(self):
         """
         The file extension for output files.
         """
-        return self.site.config.get('html_extension') or '.html'
+        return self.site._html_extension
 
 
     @property
@@ -344,11 +469,29 @@ class Page(Extendable):
         containing only certain metadata and child elements.
         For other formats, a `pintail:external` element can be used instead.
 
+        The cache file is written incrementally, and each page's data is serialized
+        as soon as it is returned. Implementations should return a new element each
+        time and should not hold on to it, so it can be freed right away.
+        Create the root element with `nsmap=CACHE_NSMAP`, so it uses the same
+        namespace prefixes as the cache file and doesn't need to declare any.
+
         For information on Mallard cache files, see http://projectmallard.org/cache/1.1/
         """
         return None
 
 
+    def release_translations(self):
+        """
+        Free any translated documents this page has kept loaded.
+
+        Pages may keep parsed translations while a build step uses them more
+        than once. The site calls this when it's done with a page in the cache
+        and HTML steps, so translations for every page aren't loaded at once.
+        Anything released is parsed again if a later step needs it.
+        """
+        pass
+
+
     def get_media(self):
         """
         Get a list of referenced media files.
@@ -446,18 +589,21 @@ class Page(Extendable):
 
         dms = self.directory.get_search_domains()
         if dms[0] == 'none':
-            return ['none']
+            self._search_domains = ['none']
+            return self._search_domains
         ret = []
         for dm in dms:
             if isinstance(dm, list):
                 if dm[0] == self.page_id:
                     if dm[1] == 'none':
-                        return ['none']
+                        self._search_domains = ['none']
+                        return self._search_domains
                     else:
                         ret.append(dm[1])
             else:
                 ret.append(dm)
-        return ret
+        self._search_domains = ret
+        return self._search_domains
 
 
     @classmethod
@@ -492,6 +638,10 @@ class Directory(Extendable):
     For simple sources, it's also where pages can be found in the source.
     """
 
+    __slots__ = ('site', 'path', 'parent', 'pages', 'subdirs', 'sources',
+                 '_search_domains', '_langs', '_stage_path', '_site_root',
+                 '_all_dirs', '_all_pages')
+
     def __init__(self, site, path, *, parent=None):
         self.site = site
         self.path = path
@@ -500,6 +650,13 @@ class Directory(Extendable):
         self.subdirs = []
         self.sources = []
         self._search_domains = None
+        self._langs = None
+        # These don't change once the directory exists, and they're used
+        # for every page, so work them out once.
+        self._stage_path = self.site.get_stage_path() + self.path
+        self._site_root = self.site.config.get_site_root(self.path)
+        self._all_dirs = None # set by Site.scan_site
+        self._all_pages = None # set by Site.scan_site
         self.scan_directory()
 
 
@@ -516,11 +673,32 @@ class Directory(Extendable):
         return self.site.translation_provider
 
 
+    def get_langs(self):
+        """
+        Get all languages this directory is translated into.
+
+        This asks the translation provider for the directory once and keeps
+        the result, since it's needed for every page and media file.
+        If there is no translation provider, this returns an empty list.
+        """
+        if self._langs is None:
+            if self.translation_provider is not None:
+                self._langs = list(self.translation_provider.get_directory_langs(self))
+            else:
+                self._langs = []
+        return self._langs
+
+
     def get_stage_path(self, lang=None):
         """
         The absolute path to the directory for staged files in this directory.
         """
-        return os.path.join(self.site.get_stage_path(lang), self.path[1:])
+        if lang is None:
+            return self._stage_path
+        # Stage and target paths are built by Pintail and directory paths
+        # always start and end with a slash, so plain concatenation works
+        # and is a good deal cheaper than os.path.join on these hot paths.
+        return self.site.get_stage_path(lang) + self.path
 
 
     def get_target_path(self, lang=None):
@@ -547,42 +725,52 @@ class Directory(Extendable):
         if len(self.sources) != 0:
             return
         # If the path corresponds to an actual on-disk directory,
-        # make a plain old source from that.
-        if os.path.isdir(os.path.join(self.site.srcdir, self.path[1:])):
+        # make a plain old source from that. If the parent directory
+        # found us while listing the source tree, we already know.
+        srcpath = os.path.join(self.site.srcdir, self.path[1:])
+        if self.path in self.site._source_dirs or os.path.isdir(srcpath):
             self.sources.append(Source(self, self.path))
         # Give each Source extension a chance to provide sources
         # for this directory with this path.
-        for cls in Source.iter_subclasses('create_sources'):
+        for cls in self.site._source_providers:
             self.sources.extend(cls.create_sources(self, self.path))
         # Finally, if there are additional sources listed in the config,
         # give each Source extension a chance to provide sources for
         # each of those sources.
         for source in (self.site.config.get('sources', self.path) or '').split():
-            for cls in Source.iter_subclasses('create_sources'):
+            for cls in self.site._source_providers:
                 self.sources.extend(cls.create_sources(self, source))
 
         # Now that we have our sources, look for subdirectories of this
         # directory, using all sources.
         for source in self.sources:
             try:
-                for name in os.listdir(source.get_source_path()):
-                    if os.path.isdir(os.path.join(source.get_source_path(), name)):
-                        subpath = self.path + name + '/'
-                        if self.site.get_ignore_directory(subpath):
-                            continue
-                        self.subdirs.append(Directory(self.site, subpath, parent=self))
+                # scandir knows entry types from the listing itself,
+                # so we don't need to stat each entry to find directories.
+                with os.scandir(source.get_source_path()) as entries:
+                    names = [entry.name for entry in entries if entry.is_dir()]
+                insrc = (source.get_source_path() == srcpath)
+                for name in names:
+                    subpath = self.path + name + '/'
+                    if self.site.get_ignore_directory(subpath):
+                        continue
+                    if insrc:
+                        self.site._source_dirs.add(subpath)
+                    self.subdirs.append(Directory(self.site, subpath, parent=self))
             except:
                 self.site.fail('Failed to list files in ' + source.get_source_path())
 
         # Finally, ask each Page extension to provide a list of pages for each source
-        by_page_id = {}
+        page_ids = set()
+        page_classes = self.site._page_providers
         for source in self.sources:
-            for cls in Page.iter_subclasses('create_pages'):
+            for cls in page_classes:
                 for page in cls.create_pages(source):
-                    if page.page_id in by_page_id:
+                    page_id = page.page_id
+                    if page_id in page_ids:
                         raise DuplicatePageException(self,
-                                                     'Duplicate page id ' + page.page_id)
-                    by_page_id[page.page_id] = page
+                                                     'Duplicate page id ' + page_id)
+                    page_ids.add(page_id)
                     self.pages.append(page)
                     source.pages.append(page)
 
@@ -591,19 +779,64 @@ class Directory(Extendable):
         """
         Iterate over this directory and all subdirectories at any depth.
         """
-        yield self
-        for subdir in self.subdirs:
-            yield from subdir.iter_directories()
+        if self._all_dirs is not None:
+            return iter(self._all_dirs)
+        return self._walk_directories()
+
+
+    def _walk_directories(self):
+        # Walk with a stack rather than recursing, so we don't build up a
+        # generator for every level. Push subdirectories in reverse so we
+        # still yield them in the same order as a depth-first recursion.
+        stack = [self]
+        while stack:
+            directory = stack.pop()
+            yield directory
+            stack.extend(reversed(directory.subdirs))
 
 
     def iter_pages(self):
         """
         Iterate over all pages in this directory and all subdirectories at any depth.
         """
-        for page in self.pages:
-            yield page
-        for subdir in self.subdirs:
-            yield from subdir.iter_pages()
+        if self._all_pages is not None:
+            return iter(self._all_pages)
+        return (page for directory in self._walk_directories()
+                for page in directory.pages)
+
+
+    def _flatten(self):
+        # Once the tree is complete, record the directories and pages under
+        # each directory as plain lists, so the many walks over the tree
+        # during a build don't have to keep traversing it. Children come
+        # after their parents in a walk, so going backwards means each
+        # subdirectory is done before the directory that contains it.
+        for directory in reversed(list(self._walk_directories())):
+            dirs = [directory]
+            pages = list(directory.pages)
+            for subdir in directory.subdirs:
+                dirs.extend(subdir._all_dirs)
+                pages.extend(subdir._all_pages)
+            directory._all_dirs = dirs
+            directory._all_pages = pages
+
+
+    def iter_filtered_directories(self):
+        """
+        Iterate over this directory and all subdirectories that meet the filter.
+
+        This is like `iter_directories`, but it only yields directories for which
+        `Site.get_filter` is true, and it doesn't descend into subdirectories that
+        can't contain any such directories. When there is no filter, it yields
+        every directory.
+        """
+        stack = [self]
+        while stack:
+            directory = stack.pop()
+            if self.site.get_filter(directory):
+                yield directory
+            stack.extend(subdir for subdir in reversed(directory.subdirs)
+                         if self.site.get_subtree_filter(subdir))
 
 
     def get_search_domains(self):
@@ -643,6 +876,13 @@ class Directory(Extendable):
             domains = 'parent'
         domains = domains.split()
 
+        # The parent's domains are cached on the parent, and we walk top-down
+        # when indexing, so this is a lookup rather than a recomputation.
+        if self.parent is None:
+            parent_domain = '/'
+        else:
+            parent_domain = self.parent.get_search_domains()[0]
+
         def _resolve(domain):
             if domain.startswith('/'):
                 return domain
@@ -652,10 +892,8 @@ class Directory(Extendable):
                 return '/'
             elif domain == 'none':
                 return 'none'
-            elif self.parent is None:
-                return '/'
             else:
-                return self.parent.get_search_domains()[0]
+                return parent_domain
 
         for i in range(len(domains)):
             if ':' in domains[i]:
@@ -664,40 +902,39 @@ class Directory(Extendable):
             else:
                 domains[i] = _resolve(domains[i])
 
+        # If the list starts with a page mapping, pages that don't match
+        # it still need a primary domain. Use the parent's.
         if isinstance(domains[0], list):
-            domains.prepend(self.parent.get_search_domains[0])
+            domains.insert(0, _resolve('parent'))
 
         self._search_domains = domains
         return self._search_domains
 
 
     def _maketargetdirs(self):
-        Site._makedirs(self.get_target_path())
-        if self.translation_provider is not None:
-            for lc in self.translation_provider.get_directory_langs(self):
-                Site._makedirs(self.get_target_path(lc))
+        self.site._ensure_dirs(self.get_target_path())
+        for lc in self.get_langs():
+            self.site._ensure_dirs(self.get_target_path(lc))
 
 
     def build_html(self):
         """
         Build HTML files for pages in this directory and subdirectories.
 
-        This method calls `build_html` on each subdirectory and each page it contains.
-        It also queries the translation provider for translations,
+        This method calls `build_html` on each page in this directory and its
+        subdirectories. It also queries the translation provider for translations,
         and calls `build_html` on each page with those languages.
+
+        Pages are collected for all directories first, and then built
+        concurrently with `Site.build_pages_html`.
         """
-        for subdir in self.subdirs:
-            subdir.build_html()
-        if not self.site.get_filter(self):
-            return
-        self._maketargetdirs()
-        for page in self.pages:
-            if not self.site.get_filter(page):
-                continue
-            page.build_html()
-            if self.translation_provider is not None:
-                for lc in self.translation_provider.get_directory_langs(self):
-                    page.build_html(lc)
+        pages = []
+        for directory in self.iter_filtered_directories():
+            directory._maketargetdirs()
+            for page in directory.pages:
+                if self.site.get_filter(page):
+                    pages.append(page)
+        self.site.build_pages_html(pages)
 
 
     def build_media(self):
@@ -711,9 +948,18 @@ class Directory(Extendable):
         It looks in both the source trees and the stage,
         so built media files in the stage will be handled here.
         This method also recurses into subdirectories.
+
+        Media files are collected for all directories first, so a file referenced
+        from many directories is only copied once. The files are then copied
+        concurrently with `Site.copy_files`.
         """
-        for subdir in self.subdirs:
-            subdir.build_media()
+        copies = {}
+        for directory in self.iter_filtered_directories():
+            directory._get_media_copies(copies)
+        self.site.copy_files(copies)
+
+
+    def _get_media_copies(self, copies):
         if not self.site.get_filter(self):
             return
         self._maketargetdirs()
@@ -725,21 +971,23 @@ class Directory(Extendable):
             # right now it's completely random which one will win.
             for filename in page.get_media():
                 media[filename] = page.source
+        # Ask for all of the directory's media in a language at once,
+        # so translation providers can batch the work.
+        translated = {}
+        for lc in self.get_langs():
+            translated[lc] = self.translation_provider.translate_media_batch(
+                [(media[fname], fname) for fname in media], lc)
         for fname in media:
             source = media[fname]
-            langs = [None]
-            if self.translation_provider is not None:
-                langs += self.translation_provider.get_directory_langs(self)
-            for lc in langs:
+            for lc in [None] + self.get_langs():
                 if lc is not None:
-                    tr = self.translation_provider.translate_media(source, fname, lc)
-                    if not tr:
+                    if not translated[lc][(source, fname)]:
                         continue
                     if fname.startswith('/'):
                         # These have to be managed with extra_files for now
                         continue
                     mediasrc = os.path.join(self.get_stage_path(lc), fname)
-                    self.site.log('MEDIA', lc + ' ' + self.path + fname)
+                    logdata = lc + ' ' + self.path + fname
                 else:
                     if fname.startswith('/'):
                         mediasrc = os.path.join(self.site.topdir, fname[1:])
@@ -750,13 +998,16 @@ class Directory(Extendable):
                         mediasrc = os.path.join(self.get_stage_path(), fname)
                         if not os.path.exists(mediasrc):
                             mediasrc = os.path.join(source.get_source_path(), fname)
-                    self.site.log('MEDIA', self.path + fname)
-                target = self.site.get_media_target_path(self, fname, lc)
-                Site._makedirs(os.path.dirname(target))
-                try:
-                    shutil.copyfile(mediasrc, target)
-                except:
-                    self.site.logger.warn('Could not copy file %s' % fname)
+                    logdata = self.path + fname
+                # Relative references from different directories can name
+                # the same target in different ways. Normalize them, so we
+                # only copy each target once.
+                target = os.path.normpath(self.site.get_media_target_path(self, fname, lc))
+                if target in copies:
+                    continue
+                self.site.log('MEDIA', logdata)
+                self.site._ensure_dirs(os.path.dirname(target))
+                copies[target] = (mediasrc, fname)
 
 
     def build_files(self):
@@ -770,23 +1021,62 @@ class Directory(Extendable):
         This method also recurses into subdirectories.
         """
         for subdir in self.subdirs:
-            subdir.build_files()
+            if self.site.get_subtree_filter(subdir):
+                subdir.build_files()
         if not self.site.get_filter(self):
             return
-        Site._makedirs(self.get_stage_path())
+        self.site._ensure_dirs(self.get_stage_path())
         globs = self.site.config.get('extra_files', self.path)
         if globs is not None:
             for glb in globs.split():
+                # Most other entries are a single star with a fixed prefix
+                # and suffix, like *.png. Match those on names from a plain
+                # directory listing rather than going through glob.
+                simple = None
+                if glob.has_magic(glb) and '/' not in glb:
+                    prefix, star, suffix = glb.partition('*')
+                    if star and not glob.has_magic(prefix) and not glob.has_magic(suffix):
+                        simple = (prefix, suffix)
                 for source in self.sources:
                     # This won't do what it should if the path has anything
                     # glob-like in it. Would be nice if glob() could take
                     # a base path that isn't glob-interpreted.
-                    files = glob.glob(os.path.join(source.get_source_path(), glb))
+                    path = os.path.join(source.get_source_path(), glb)
+                    # Most entries are just file names. Don't bother listing
+                    # and matching the whole directory for those.
+                    if simple is not None:
+                        files = Directory._match_files(source.get_source_path(), *simple)
+                    elif glob.has_magic(glb):
+                        files = glob.iglob(path)
+                    elif os.path.exists(path):
+                        files = [path]
+                    else:
+                        files = []
                     for fname in files:
-                        self.site.log('FILE', self.path + os.path.basename(fname))
-                        shutil.copyfile(fname,
-                                        os.path.join(self.get_target_path(),
-                                                     os.path.basename(fname)))
+                        basename = os.path.basename(fname)
+                        self.site.log('FILE', self.path + basename)
+                        Site._copyfile(fname,
+                                       os.path.join(self.get_target_path(), basename))
+
+
+    @classmethod
+    def _match_files(cls, path, prefix, suffix):
+        # Like glob on prefix*suffix in path, including glob's habit of
+        # skipping hidden files unless the pattern asks for them.
+        minlen = len(prefix) + len(suffix)
+        ret = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if name.startswith('.') and not prefix.startswith('.'):
+                        continue
+                    if (len(name) >= minlen and name.startswith(prefix) and
+                        name.endswith(suffix) and entry.is_file()):
+                        ret.append(entry.path)
+        except OSError:
+            pass
+        return ret
 
 
     def build_feeds(self):
@@ -795,61 +1085,62 @@ class Directory(Extendable):
 
         If the directory lists a file name in the `feed_atom` config option,
         then this method creates an Atom feed from the pages in the directory.
-        This method also recurses into subdirectories.
-        """
-        for subdir in self.subdirs:
-            subdir.build_feeds()
-        if not self.site.get_filter(self):
+        This method also builds feeds for all subdirectories.
+        """
+        # Check the filter and the feed_atom option, which are both cheap,
+        # before doing any of the setup that only matters if there's a feed.
+        feeds = []
+        for directory in self.iter_filtered_directories():
+            atomfile = self.site.config.get('feed_atom', directory.path)
+            if atomfile is not None:
+                feeds.append((directory, atomfile))
+        if len(feeds) == 0:
             return
-        atomfile = self.site.config.get('feed_atom', self.path)
-        if atomfile is not None:
-            self.site.log('ATOM', self.path + atomfile)
-
-            Site._makedirs(self.site.tools_path)
-            for xsltfile in ('pintail-html.xsl', 'pintail-atom.xsl'):
-                xsltpath = os.path.join(self.site.tools_path, xsltfile)
-                if not os.path.exists(xsltpath):
-                    from pkg_resources import resource_string
-                    xsltcont = resource_string(__name__, xsltfile)
-                    fd = open(xsltpath, 'w')
-                    fd.write(codecs.decode(xsltcont, 'utf-8'))
-                    fd.close()
-
-            mal2xhtml = os.path.join(self.site.yelp_xsl_path,
-                                     'xslt', 'mallard', 'html', 'mal2xhtml.xsl')
-
-            atomxsl = os.path.join(self.site.tools_path, 'pintail-atom-local.xsl')
-            fd = open(atomxsl, 'w')
-            fd.write('<xsl:stylesheet' +
-                     ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"' +
-                     ' version="1.0">\n')
-            fd.write('<xsl:import href="' + mal2xhtml + '"/>\n')
-            fd.write('<xsl:import href="pintail-atom.xsl"/>\n')
-            html_extension = self.site.config.get('html_extension') or '.html'
-            fd.write('<xsl:param name="html.extension" select="' +
-                     "'" + html_extension + "'" + '"/>\n')
-            link_extension = self.site.config.get('link_extension')
-            if link_extension is not None:
-                fd.write('<xsl:param name="mal.link.extension" select="' +
-                         "'" + link_extension + "'" + '"/>\n')
-                fd.write('<xsl:param name="pintail.extension.link" select="' +
-                         "'" + link_extension + "'" + '"/>\n')
-            for xsl in self.site.get_custom_xsl():
-                fd.write('<xsl:include href="%s"/>\n' % xsl)
-            fd.write('</xsl:stylesheet>')
-            fd.close()
-
-            root = self.site.config.get('feed_root', self.path)
-            if root is None:
-                root = self.site.config.get_site_root(self.path)
-
-            subprocess.call(['xsltproc',
-                             '-o', os.path.join(self.get_target_path(), atomfile),
-                             '--stringparam', 'pintail.site.dir', self.path,
-                             '--stringparam', 'pintail.site.root', root,
-                             '--stringparam', 'feed.exclude_styles',
-                             self.site.config.get('feed_exclude_styles', self.path) or '',
-                             atomxsl, self.site.get_cache_path()])
+
+        # Write the shared stylesheet and parse the cache before starting
+        # any workers. Each worker thread compiles its own copy of the
+        # stylesheet and makes its own copy of the cache, because libxslt
+        # strips whitespace from its input in place for xsl:strip-space.
+        # Copying the parsed tree is still cheaper than parsing it again.
+        self.site._ensure_atom_xsl()
+        cache = self.site._get_cache_tree()
+        local = threading.local()
+        def _build(directory, atomfile):
+            tree = getattr(local, 'cache', None)
+            if tree is None:
+                tree = local.cache = copy.deepcopy(cache)
+            directory._build_feed(atomfile, tree)
+
+        jobs = self.site.get_feed_jobs()
+        if jobs <= 1 or len(feeds) == 1:
+            for directory, atomfile in feeds:
+                _build(directory, atomfile)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_build, directory, atomfile)
+                       for directory, atomfile in feeds]
+            for future in futures:
+                future.result()
+
+
+    def _build_feed(self, atomfile, cache):
+        self.site.log('ATOM', self.path + atomfile)
+
+        root = self.site.config.get('feed_root', self.path)
+        if root is None:
+            root = self._site_root
+        exclude = self.site.config.get('feed_exclude_styles', self.path) or ''
+
+        atom = self.site.get_compiled_xsl(self.site._atom_xsl)
+        result = atom(cache, **{
+            'pintail.site.dir': etree.XSLT.strparam(self.path),
+            'pintail.site.root': etree.XSLT.strparam(root),
+            'feed.exclude_styles': etree.XSLT.strparam(exclude)
+        })
+        self.site._ensure_dirs(self.get_target_path())
+        with open(os.path.join(self.get_target_path(), atomfile), 'wb') as fd:
+            fd.write(bytes(result))
 
 
 class Source(Extendable):
@@ -897,24 +1188,31 @@ class Site:
     """
     Base class for an entire Pintail site.
     """
+
     def __init__(self, configfile,
                  local=False,
                  search=True,
                  translation=True,
                  update=True,
-                 verbose=False):
+                 verbose=False,
+                 jobs=None):
         self._configfile = configfile
         self.topdir = os.path.dirname(configfile)
         self.srcdir = self.topdir
         self.pindir = os.path.join(self.topdir, '__pintail__')
         self.target_path = os.path.join(self.pindir, 'build')
         self.tools_path = os.path.join(self.pindir, 'tools')
+        self._target_root = (None, None)
+        # Log messages show paths in __pintail__ relative to the site.
+        self._log_prefix = self.pindir + '/'
+        self._log_strip = len(os.path.dirname(self.pindir)) + 1
 
         self.logger = logging.getLogger('pintail')
         self.logger.addHandler(logging.StreamHandler())
         if verbose:
             self.logger.setLevel(logging.INFO)
         self._verbose = verbose
+        self._jobs = jobs
 
         self._local = local
         self._update = update
@@ -922,9 +1220,24 @@ class Site:
         self._translation = translation
         self._command = None
         self._filter = []
+        self._filter_dirs = ()
+        self._filter_pages = frozenset()
 
         self.config = None # set by prep_site
         self.root = None # set by scan_site
+        self._all_pages = None # set by scan_site
+
+        self._atom_xsl = None
+        self._made_dirs = set()
+        self._compiled_xsl = threading.local()
+        self._cache_trees = {}
+        self._translated_pages = {}
+        self._source_dirs = set()
+        self._xsl_params_cache = {}
+        self._tools_future = None
+        self._tools_lock = threading.Lock()
+        self._tools_proc = None
+        self._tools_stopped = False
 
 
     @classmethod
@@ -941,11 +1254,8 @@ class Site:
         if os.path.exists(cfgfile):
             sys.stderr.write('pintail.cfg file already exists\n')
             sys.exit(1)
-        from pkg_resources import resource_string
-        sample = resource_string(__name__, 'sample.cfg')
-        fd = open(cfgfile, 'w')
-        fd.write(codecs.decode(sample, 'utf-8'))
-        fd.close()
+        with open(cfgfile, 'wb') as fd:
+            fd.write(_get_resource('sample.cfg'))
 
 
     def get_script_env(self, config=None):
@@ -1014,7 +1324,7 @@ class Site:
         if not self._update:
             env['PINTAIL_NO_UPDATE'] = '1'
 
-        self._makedirs(self.target_path)
+        self._ensure_dirs(self.target_path)
         env['PINTAIL_OUTPUT'] = self.target_path
         env['PINTAIL_SITE_ROOT'] = config.get_site_root()
         if self._verbose:
@@ -1031,12 +1341,19 @@ class Site:
         If the filter ends with a slash, it is a directory. Otherwise, it is a page.
         """
         self._filter = []
+        self._filter_dirs = ()
+        self._filter_pages = frozenset()
         if dirs is None:
             return
         for fdir in dirs:
             if not(fdir.startswith('/')):
                 fdir = '/' + fdir
             self._filter.append(fdir)
+        # get_filter is called for every directory and page in each build
+        # stage, so split the filter once into directory prefixes, which
+        # str.startswith can check as a tuple, and a set of page ids.
+        self._filter_dirs = tuple(f for f in self._filter if f.endswith('/'))
+        self._filter_pages = frozenset(f for f in self._filter if not f.endswith('/'))
 
 
     def get_filter(self, obj):
@@ -1048,21 +1365,32 @@ class Site:
         if len(self._filter) == 0:
             return True
         if isinstance(obj, Directory):
-            for f in self._filter:
-                if f.endswith('/'):
-                    if obj.path.startswith(f):
-                        return True
-                else:
-                    if f.startswith(obj.path):
-                        return True
+            if obj.path.startswith(self._filter_dirs):
+                return True
+            for f in self._filter_pages:
+                if f.startswith(obj.path):
+                    return True
         elif isinstance(obj, Page):
-            for f in self._filter:
-                if f.endswith('/'):
-                    if obj.site_id.startswith(f):
-                        return True
-                else:
-                    if obj.site_id == f:
-                        return True
+            if obj.site_id.startswith(self._filter_dirs):
+                return True
+            if obj.site_id in self._filter_pages:
+                return True
+        return False
+
+
+    def get_subtree_filter(self, directory):
+        """
+        Get whether a directory or any of its subdirectories could meet the filter.
+
+        Build methods use this to skip whole subtrees on filtered builds.
+        A directory that is an ancestor of a filtered path does not itself
+        meet the filter, but it still has to be walked.
+        """
+        if len(self._filter) == 0:
+            return True
+        for f in self._filter:
+            if f.startswith(directory.path) or directory.path.startswith(f):
+                return True
         return False
 
 
@@ -1078,11 +1406,105 @@ class Site:
         custom_xsl = self.config.get('custom_xsl') or ''
         for x in custom_xsl.split():
             ret.append(os.path.join(self.topdir, x))
-        for cls in XslProvider.iter_subclasses('get_xsl'):
+        for cls in self._xsl_providers:
             ret.extend(cls.get_xsl(self))
         return ret
 
 
+    def get_jobs(self):
+        """
+        Get the number of pages to build at once.
+
+        This returns the value passed to `--jobs` on the command line,
+        or the number of processors if it was not passed.
+        """
+        if self._jobs is not None:
+            return max(1, self._jobs)
+        return os.cpu_count() or 1
+
+
+    def get_feed_jobs(self):
+        """
+        Get the number of feeds to build at once.
+
+        This returns the value of the `feed_jobs` config option, or the value
+        of `get_jobs` if that option is not set or is not a number.
+        """
+        jobs = self.config.get('feed_jobs')
+        if jobs is not None:
+            try:
+                return max(1, int(jobs))
+            except ValueError:
+                self.warn('Invalid value for feed_jobs: %s' % jobs)
+        return self.get_jobs()
+
+
+    def get_compiled_xsl(self, name):
+        """
+        Get a compiled XSLT stylesheet as an `lxml.etree.XSLT` object.
+
+        The `name` parameter is the file name of a stylesheet in the tools
+        directory, or an absolute path. Stylesheets are parsed and compiled
+        the first time they're asked for, and the same object is returned
+        after that. Compiled stylesheets are kept separately for each thread,
+        because lxml copies a stylesheet on every call when it is used from
+        a thread other than the one that compiled it.
+        """
+        cache = getattr(self._compiled_xsl, 'cache', None)
+        if cache is None:
+            cache = self._compiled_xsl.cache = {}
+        if name not in cache:
+            cache[name] = etree.XSLT(etree.parse(os.path.join(self.tools_path, name)))
+        return cache[name]
+
+
+    def _ensure_atom_xsl(self):
+        # Every directory with a feed uses the same stylesheet. Only the
+        # directory and root params change, so write it once per build,
+        # and pass those as stylesheet params for each feed.
+        if self._atom_xsl is not None:
+            return self._atom_xsl
+
+        self._ensure_dirs(self.tools_path)
+        for xsltfile in ('pintail-html.xsl', 'pintail-atom.xsl'):
+            xsltpath = os.path.join(self.tools_path, xsltfile)
+            if not os.path.exists(xsltpath):
+                with open(xsltpath, 'wb') as fd:
+                    fd.write(_get_resource(xsltfile))
+
+        mal2xhtml = os.path.join(self.yelp_xsl_path,
+                                 'xslt', 'mallard', 'html', 'mal2xhtml.xsl')
+        html_extension = self._html_extension
+        link_extension = self._link_extension
+
+        stylesheet = XSL.stylesheet(
+            XSL('import', href=mal2xhtml),
+            XSL('import', href='pintail-atom.xsl'),
+            XSL.param(name='html.extension', select="'" + html_extension + "'"),
+            version='1.0')
+        if link_extension is not None:
+            stylesheet.append(XSL.param(name='mal.link.extension',
+                                        select="'" + link_extension + "'"))
+            stylesheet.append(XSL.param(name='pintail.extension.link',
+                                        select="'" + link_extension + "'"))
+        for xsl in self.get_custom_xsl():
+            stylesheet.append(XSL.include(href=xsl))
+
+        atomxsl = os.path.join(self.tools_path, 'pintail-atom-local.xsl')
+        etree.ElementTree(stylesheet).write(atomxsl)
+        self._atom_xsl = atomxsl
+        return atomxsl
+
+
+    def _get_cache_tree(self, lang=None):
+        # Feeds and scripts read the same cache file, so parse it once per
+        # build. XSLT may strip whitespace from its input in place, so don't
+        # hand this tree to transforms running at the same time. Copy it.
+        if lang not in self._cache_trees:
+            self._cache_trees[lang] = etree.parse(self.get_cache_path(lang))
+        return self._cache_trees[lang]
+
+
     def get_langs(self):
         """
         Get all languages used throughout the site.
@@ -1111,10 +1533,12 @@ class Site:
         """
         The absolute path to the directory for staged files for this site.
         """
+        # This is called for every page in every language, so concatenate
+        # rather than join. Pintail builds pindir, so it has no trailing slash.
         if lang is not None:
-            return os.path.join(self.pindir, 'stage-' + lang)
+            return self.pindir + '/stage-' + lang
         else:
-            return os.path.join(self.pindir, 'stage')
+            return self.pindir + '/stage'
 
 
     def get_cache_path(self, lang=None):
@@ -1122,16 +1546,25 @@ class Site:
         The absolute path to the Mallard cache file for the site in the language.
         """
         if lang is not None:
-            return os.path.join(self.tools_path, 'pintail-' + lang + '.cache')
+            return self.tools_path + '/pintail-' + lang + '.cache'
         else:
-            return os.path.join(self.tools_path, 'pintail.cache')
+            return self.tools_path + '/pintail.cache'
 
 
     def get_directory_target_path(self, directory, lang=None):
         """
         The absolute path to where the built files for a directory should go.
         """
-        return os.path.join(self.target_path, directory.path[1:])
+        return self._get_target_root() + directory.path
+
+
+    def _get_target_root(self):
+        # The target path can be changed after the site is created, as with
+        # pintail --output, so strip it when it changes rather than on
+        # every call for every page and media file.
+        if self._target_root[0] != self.target_path:
+            self._target_root = (self.target_path, self.target_path.rstrip('/'))
+        return self._target_root[1]
 
 
     def get_page_target_path(self, page, lang=None):
@@ -1140,9 +1573,9 @@ class Site:
         """
         dirpath = self.get_directory_target_path(page.directory)
         if lang is None:
-            return os.path.join(dirpath, page.target_file)
+            return dirpath + page.target_file
         else:
-            return os.path.join(dirpath, page.target_file + '.' + lang)
+            return dirpath + page.target_file + '.' + lang
 
 
     def get_media_target_path(self, directory, mediafile, lang=None):
@@ -1154,20 +1587,26 @@ class Site:
         else:
             langext = ''
         if mediafile.startswith('/'):
-            return os.path.join(self.target_path, mediafile[1:] + langext)
+            return self._get_target_root() + mediafile + langext
         else:
-            return os.path.join(directory.get_target_path(), mediafile + langext)
+            return directory.get_target_path() + mediafile + langext
 
 
     def translate_page(self, page, lang):
         """
         Translate a page into a language and return whether it was translated.
 
-        If there is no translation provider, this method just returns `False`.
+        If there is no translation provider, or if the page's directory is not
+        translated into the language, this method just returns `False`.
         Otherwise, it first checks to see if the translated file already exists,
         and if it doesn't, it calls `translate_page` on the translation provider.
         """
         if self.translation_provider is not None:
+            translated = self._translated_pages.get((page, lang))
+            if translated is not None:
+                return translated
+            if not page.directory.translation_provider.directory_supports(page.directory, lang):
+                return False
             if not self.get_filter(page):
                 if os.path.exists(page.get_stage_path(lang)):
                     return True
@@ -1175,6 +1614,89 @@ class Site:
         return False
 
 
+    def _translate_pages(self, lang):
+        # If the translation provider can translate many pages at once, have
+        # it do every page that translate_page would send its way up front,
+        # and remember the answers for translate_page.
+        provider = self.translation_provider
+        if provider is None:
+            return
+        import pintail.translation
+        if type(provider).translate_pages is pintail.translation.TranslationProvider.translate_pages:
+            return
+        pages = [page for page in self._all_pages
+                 if provider.directory_supports(page.directory, lang) and
+                 (self.get_filter(page) or not os.path.exists(page.get_stage_path(lang)))]
+        for page, translated in provider.translate_pages(pages, lang).items():
+            self._translated_pages[(page, lang)] = translated
+
+
+    def copy_files(self, copies):
+        """
+        Copy a set of files into the built site.
+
+        The `copies` argument is a dict mapping each target path to a tuple
+        of the source path and the name to use in warnings. Copying files mostly
+        waits on the disk, so this method copies files concurrently in a pool
+        of threads. Directories for the targets must already exist.
+
+        When several targets come from the same source file, the file is
+        copied once, and the other targets are hard links to that copy.
+        """
+        bysource = {}
+        for target in copies:
+            bysource.setdefault(copies[target][0], []).append(target)
+        def _copy(src):
+            targets = bysource[src]
+            try:
+                Site._copyfile(src, targets[0])
+            except OSError:
+                return targets
+            failed = []
+            for target in targets[1:]:
+                try:
+                    Site._linkfile(targets[0], target)
+                except OSError:
+                    failed.append(target)
+            return failed
+        # Threads spend nearly all their time waiting on the disk, so use
+        # more of them than there are CPUs to keep the device queue full.
+        workers = min(32, (os.cpu_count() or 1) * 4)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for failed in executor.map(_copy, bysource):
+                for target in failed:
+                    self.logger.warn('Could not copy file %s' % copies[target][1])
+
+
+    def build_pages_html(self, pages):
+        """
+        Build HTML files for a list of pages, including all translations.
+
+        Most of the time building HTML is spent inside XSLT transforms, which
+        don't hold the interpreter lock, so this method builds pages concurrently
+        in a pool of threads, sized by `get_jobs`. All languages for a page are
+        built in the same thread, so no page's document is used by two threads
+        at once. Target directories must already exist.
+        """
+        def _build(page):
+            page.build_html()
+            for lc in page.directory.get_langs():
+                page.build_html(lc)
+            page.release_translations()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.get_jobs())
+        try:
+            for _ in executor.map(_build, pages):
+                pass
+        finally:
+            # If a page fails or the build is interrupted,
+            # don't keep building the rest of the queue.
+            executor.shutdown(cancel_futures=True)
+        # Stacked builds load the translations of other pages in the
+        # directory, which may have been built and released already.
+        for page in pages:
+            page.release_translations()
+
+
     def prep_site(self):
         """
         Prepare the site and configuration data.
@@ -1195,6 +1717,34 @@ class Site:
         self.yelp_xsl_dir = 'yelp-xsl@' + self.yelp_xsl_branch.replace('/', '@')
         self.yelp_xsl_path = os.path.join(self.tools_path, self.yelp_xsl_dir)
 
+        # Pages get the time the build started, not the moment each page
+        # happened to be transformed.
+        now = datetime.datetime.now()
+        self._build_date = now.strftime('%Y-%m-%d')
+        self._build_time = now.strftime('%T')
+        self._html_extension = self.config.get('html_extension') or '.html'
+        self._link_extension = self.config.get('link_extension')
+
+        # Ignoring a directory ignores everything under it. Plain paths are
+        # checked with a single startswith on a tuple of prefixes. Glob
+        # patterns get a trailing * for the same effect, and are all
+        # combined into one regular expression.
+        ignore = set(['/__pintail__/', '/.git/'])
+        patterns = []
+        for path in (self.config.get('ignore_directories') or '').split():
+            if not path.startswith('/'):
+                path = '/' + path
+            if not path.endswith('/'):
+                path = path + '/'
+            if glob.has_magic(path):
+                patterns.append(fnmatch.translate(path + '*'))
+            else:
+                ignore.add(path)
+        self._ignore_dirs = tuple(sorted(ignore))
+        self._ignore_re = None
+        if len(patterns) > 0:
+            self._ignore_re = re.compile('|'.join(patterns))
+
         for plugin in (self.config.get('plugins') or '').split():
             importlib.import_module(plugin)
 
@@ -1215,6 +1765,15 @@ class Site:
                 transcls = getattr(transmod, trans[dot+1:])
                 self.translation_provider = transcls(self)
 
+        # All plugins are loaded now, so the set of extensions is fixed.
+        # Look them up once rather than walking the class tree every time.
+        self._tools_providers = tuple(ToolsProvider.iter_subclasses('build_tools'))
+        self._css_providers = tuple(CssProvider.iter_subclasses('build_css'))
+        self._xsl_providers = tuple(XslProvider.iter_subclasses('get_xsl'))
+        self._xsl_param_providers = tuple(XslProvider.iter_subclasses('get_xsl_params'))
+        self._source_providers = tuple(Source.iter_subclasses('create_sources'))
+        self._page_providers = tuple(Page.iter_subclasses('create_pages'))
+
 
     def scan_site(self):
         """
@@ -1234,34 +1793,37 @@ class Site:
         self.log('SCAN', '/')
         if os.path.exists(self.get_stage_path()):
             shutil.rmtree(self.get_stage_path())
+        self._forget_dirs(self.get_stage_path())
         self.root = Directory(self, '/')
         directories = {'/': self.root}
         for directory in self.root.iter_directories():
             directories[directory.path] = directory
 
-        configdirs = set([d for d in self.config._config.sections()
-                          if d.startswith('/') and d.endswith('/')] +
-                         [d for d in self.config._configscr.sections()
-                          if d.startswith('/') and d.endswith('/')] )
-        for path in configdirs:
-            if path not in directories:
-                parent = directories['/']
-                curpath = '/'
-                for curpart in path[1:-1].split('/'):
-                    curpath = curpath + curpart + '/'
-                    if curpath in directories:
-                        parent = directories[curpath]
-                    else:
-                        curdir = Directory(self, curpath, parent=parent)
-                        parent.subdirs.append(curdir)
-                        directories[curpath] = curdir
-                        parent = curdir
+        configdirs = set(self.config._dirs)
+        # Add all ancestors, then go shallowest first. That way the parent
+        # of each directory we create is always already in directories.
+        for path in list(configdirs):
+            while path != '/':
+                path = path[:path.rindex('/', 0, -1) + 1]
+                if path in configdirs:
+                    break
+                configdirs.add(path)
+        for path in sorted(configdirs, key=lambda path: path.count('/')):
+            if path in directories:
+                continue
+            parent = directories[path[:path.rindex('/', 0, -1) + 1]]
+            curdir = Directory(self, path, parent=parent)
+            parent.subdirs.append(curdir)
+            for directory in curdir.iter_directories():
+                directories[directory.path] = directory
 
         for path in directories:
             directory = directories[path]
-            if directory.translation_provider is not None:
-                for lc in directory.translation_provider.get_directory_langs(directory):
-                    directory.translation_provider.translate_directory(directory, lc)
+            for lc in directory.get_langs():
+                directory.translation_provider.translate_directory(directory, lc)
+
+        self.root._flatten()
+        self._all_pages = self.root._all_pages
 
 
     def build(self, command='build'):
@@ -1308,17 +1870,26 @@ class Site:
         Build the entire site, including all pages and additional files.
         """
         self.prep_site()
-        self.scan_site()
-        self.build_cache()
-        self.build_tools()
-        self.build_html()
-        self.build_media()
-        self.build_files()
-        self.build_feeds()
-        self.build_search()
-        if len(self._filter) == 0:
-            self.build_css()
-            self.build_js()
+        self._start_tools()
+        try:
+            self.scan_site()
+            self._check_tools()
+            self.build_cache()
+            self._check_tools()
+            # Copying media and extra files doesn't need yelp-xsl, so do it
+            # while the tools are still being fetched and built.
+            self.build_media()
+            self._check_tools()
+            self.build_files()
+            self.build_tools()
+            self.build_html()
+            self.build_feeds()
+            self.build_search()
+            if len(self._filter) == 0:
+                self.build_css()
+                self.build_js()
+        finally:
+            self._stop_tools()
 
 
     def build_cache(self):
@@ -1327,34 +1898,110 @@ class Site:
         """
         self.prep_site()
         self.scan_site()
-        self.log('CACHE', self.get_cache_path())
-        cache = etree.Element(CACHE_NS + 'cache', nsmap={
-            None: 'http://projectmallard.org/1.0/',
-            'cache': 'http://projectmallard.org/cache/1.0/',
-            'site': 'http://projectmallard.org/site/1.0/',
-            'pintail': 'http://pintail.io/'
-        })
-        for page in self.root.iter_pages():
-            cdata = page.get_cache_data()
-            if cdata is not None:
-                cache.append(cdata)
-        Site._makedirs(self.tools_path)
-        cache.getroottree().write(self.get_cache_path(),
-                                  pretty_print=True)
-        for lang in self.get_langs():
-            self.log('CACHE', self.get_cache_path(lang))
-            cache = etree.Element(CACHE_NS + 'cache', nsmap={
-                None: 'http://projectmallard.org/1.0/',
-                'cache': 'http://projectmallard.org/cache/1.0/',
-                'site': 'http://projectmallard.org/site/1.0/',
-                'pintail': 'http://pintail.io/'
-            })
-            for page in self.root.iter_pages():
-                cdata = page.get_cache_data(lang)
-                if cdata is not None:
-                    cache.append(cdata)
-            cache.getroottree().write(self.get_cache_path(lang),
-                                      pretty_print=True)
+        self._ensure_dirs(self.tools_path)
+        self._write_caches([None] + self.get_langs())
+
+
+    def _write_caches(self, langs):
+        # Write each page's data out as soon as we have it, rather than
+        # building the whole cache in memory and serializing it at the end.
+        # All the cache files are written together in one pass over the
+        # pages, so each page's source and translations are handled while
+        # they're still loaded, instead of once per language.
+        for lang in langs:
+            if lang is not None:
+                self._translate_pages(lang)
+        with contextlib.ExitStack() as stack:
+            writers = []
+            for lang in langs:
+                self.log('CACHE', self.get_cache_path(lang))
+                self._cache_trees.pop(lang, None)
+                xf = stack.enter_context(etree.xmlfile(self.get_cache_path(lang),
+                                                       encoding='utf-8'))
+                xf.write_declaration()
+                stack.enter_context(xf.element(CACHE_NS + 'cache', nsmap=CACHE_NSMAP))
+                xf.write('\n')
+                writers.append((lang, xf))
+            for page in self._all_pages:
+                for lang, xf in writers:
+                    cdata = page.get_cache_data(lang)
+                    if cdata is not None:
+                        _write_cache_data(xf, cdata)
+                        if not cdata.tail:
+                            xf.write('\n')
+                page.release_translations()
+
+
+    def _start_tools(self):
+        # Fetching and building yelp-xsl is all subprocess work, so start it
+        # in the background and let the directory scan and cache build run
+        # alongside it. build_tools waits on the result.
+        if self._tools_future is not None:
+            return
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._tools_future = executor.submit(self._prepare_tools_bg)
+        executor.shutdown(wait=False)
+
+
+    def _prepare_tools_bg(self):
+        self._ensure_dirs(self.tools_path)
+        if os.path.exists(self.yelp_xsl_path):
+            if self._update:
+                self.log('UPDATE', 'https://gitlab.gnome.org/GNOME/yelp-xsl@' + self.yelp_xsl_branch)
+                self._run_tools_command(['git', 'pull', '-q', '-r', 'origin', self.yelp_xsl_branch],
+                                        cwd=os.path.join(self.tools_path,
+                                                         'yelp-xsl@' + self.yelp_xsl_branch))
+        else:
+            self.log('CLONE', 'https://gitlab.gnome.org/GNOME/yelp-xsl@' + self.yelp_xsl_branch)
+            self._run_tools_command(['git', 'clone', '-q',
+                                     '-b', self.yelp_xsl_branch, '--single-branch',
+                                     'https://gitlab.gnome.org/GNOME/yelp-xsl.git',
+                                     self.yelp_xsl_dir],
+                                    cwd=self.tools_path)
+        self.log('BUILD', 'https://gitlab.gnome.org/GNOME/yelp-xsl@' + self.yelp_xsl_branch)
+        if os.path.exists(os.path.join(self.yelp_xsl_path, 'localbuild.sh')):
+            self._run_tools_command([os.path.join(self.yelp_xsl_path, 'localbuild.sh')],
+                                    cwd=self.yelp_xsl_path,
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL)
+        else:
+            self._run_tools_command([os.path.join(self.yelp_xsl_path, 'autogen.sh')],
+                                    cwd=self.yelp_xsl_path,
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL)
+            self._run_tools_command(['make'], cwd=self.yelp_xsl_path, stdout=subprocess.DEVNULL)
+
+
+    def _run_tools_command(self, args, **kwargs):
+        # Keep track of the running command, so _stop_tools can end it
+        # if the rest of the build stops before the tools are done.
+        with self._tools_lock:
+            if self._tools_stopped:
+                return
+            p = subprocess.Popen(args, **kwargs)
+            self._tools_proc = p
+        p.communicate()
+
+
+    def _check_tools(self):
+        # Raise any error from building the tools in the background as soon
+        # as we know about it, rather than waiting until build_tools.
+        if self._tools_future is not None and self._tools_future.done():
+            self._tools_future.result()
+
+
+    def _stop_tools(self):
+        # Don't leave the tools building in the background if the build
+        # stops early. The interpreter would wait for it at exit, and any
+        # error from it would go unseen.
+        if self._tools_future is None:
+            return
+        if not self._tools_future.done():
+            with self._tools_lock:
+                self._tools_stopped = True
+                if self._tools_proc is not None and self._tools_proc.poll() is None:
+                    self._tools_proc.terminate()
+        self._tools_future.result()
 
 
     def build_tools(self):
@@ -1366,46 +2013,13 @@ class Site:
         and finally calls `get_tools` on each `ToolsProvider`.
         """
         self.prep_site()
-        Site._makedirs(self.tools_path)
-        if os.path.exists(self.yelp_xsl_path):
-            if self._update:
-                self.log('UPDATE', 'https://gitlab.gnome.org/GNOME/yelp-xsl@' + self.yelp_xsl_branch)
-                p = subprocess.Popen(['git', 'pull', '-q', '-r', 'origin', self.yelp_xsl_branch],
-                                     cwd=os.path.join(self.tools_path,
-                                                      'yelp-xsl@' + self.yelp_xsl_branch))
-                p.communicate()
-        else:
-            self.log('CLONE', 'https://gitlab.gnome.org/GNOME/yelp-xsl@' + self.yelp_xsl_branch)
-            p = subprocess.Popen(['git', 'clone', '-q',
-                                  '-b', self.yelp_xsl_branch, '--single-branch',
-                                  'https://gitlab.gnome.org/GNOME/yelp-xsl.git',
-                                  self.yelp_xsl_dir],
-                                 cwd=self.tools_path)
-            p.communicate()
-        self.log('BUILD', 'https://gitlab.gnome.org/GNOME/yelp-xsl@' + self.yelp_xsl_branch)
-        if os.path.exists(os.path.join(self.yelp_xsl_path, 'localbuild.sh')):
-            p = subprocess.Popen([os.path.join(self.yelp_xsl_path, 'localbuild.sh')],
-                                 cwd=self.yelp_xsl_path,
-                                 stdout=subprocess.DEVNULL,
-                                 stderr=subprocess.DEVNULL)
-            p.communicate()
-        else:
-            p = subprocess.Popen([os.path.join(self.yelp_xsl_path, 'autogen.sh')],
-                                 cwd=self.yelp_xsl_path,
-                                 stdout=subprocess.DEVNULL,
-                                 stderr=subprocess.DEVNULL)
-            p.communicate()
-            p = subprocess.Popen(['make'], cwd=self.yelp_xsl_path, stdout=subprocess.DEVNULL)
-            p.communicate()
-
-        from pkg_resources import resource_string
-        site2html = resource_string(__name__, 'pintail-html.xsl')
-        fd = open(os.path.join(self.tools_path, 'pintail-html.xsl'),
-                  'w', encoding='utf-8')
-        fd.write(codecs.decode(site2html, 'utf-8'))
-        fd.close()
-
-        for cls in ToolsProvider.iter_subclasses('build_tools'):
+        self._start_tools()
+        self._tools_future.result()
+
+        with open(os.path.join(self.tools_path, 'pintail-html.xsl'), 'wb') as fd:
+            fd.write(_get_resource('pintail-html.xsl'))
+
+        for cls in self._tools_providers:
             cls.build_tools(self)
 
 
@@ -1435,7 +2049,7 @@ class Site:
         """
         self.prep_site()
         self.scan_site()
-        for cls in CssProvider.iter_subclasses('build_css'):
+        for cls in self._css_providers:
             cls.build_css(self)
 
 
@@ -1446,103 +2060,104 @@ class Site:
         self.prep_site()
         self.scan_site()
         jspath = os.path.join(self.yelp_xsl_path, 'js')
+        # The static scripts are copied together at the end, so the copies
+        # all go through the same pool of threads as media files.
+        copies = {}
+        def _copy_js(js):
+            target = os.path.join(self.target_path, js)
+            if target in copies:
+                return
+            self.log('JS', '/' + js)
+            copies[target] = (os.path.join(jspath, js), js)
 
         if os.path.exists(os.path.join(jspath, 'jquery.js')):
-            self.log('JS', '/jquery.js')
-            shutil.copyfile(os.path.join(jspath, 'jquery.js'),
-                            os.path.join(self.target_path, 'jquery.js'))
+            _copy_js('jquery.js')
 
         xslpath = os.path.join(self.yelp_xsl_path, 'xslt')
-        Site._makedirs(self.tools_path)
+        self._ensure_dirs(self.tools_path)
 
         jsxsl = os.path.join(self.tools_path, 'pintail-js.xsl')
-        fd = open(jsxsl, 'w')
-        fd.writelines([
-            '<xsl:stylesheet',
-            ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"',
-            ' xmlns:exsl="http://exslt.org/common"',
-            ' xmlns:cache="http://projectmallard.org/cache/1.0/"',
-            ' xmlns:mal="http://projectmallard.org/1.0/"',
-            ' extension-element-prefixes="exsl"',
-            ' version="1.0">\n'
-            '<xsl:import href="', xslpath, '/mallard/html/mal2xhtml.xsl"/>\n'
-            ])
-        fd.write('<xsl:import href="%s"/>\n' % 'pintail-html.xsl')
-        for xsl in self.get_custom_xsl():
-            fd.write('<xsl:include href="%s"/>\n' % xsl)
-        fd.writelines([
-            '<xsl:output method="text"/>\n',
-            '<xsl:template match="/">\n',
-            ' <xsl:call-template name="html.js.content"/>\n',
-            '</xsl:template>\n',
-            '</xsl:stylesheet>\n'
-            ])
-        fd.close()
+        stylesheet = XSL.stylesheet(
+            XSL('import', href=os.path.join(xslpath, 'mallard', 'html', 'mal2xhtml.xsl')),
+            XSL('import', href='pintail-html.xsl'),
+            *[XSL.include(href=xsl) for xsl in self.get_custom_xsl()],
+            XSL.output(method='text'),
+            XSL.template(XSL('call-template', name='html.js.content'), match='/'),
+            version='1.0')
+        etree.ElementTree(stylesheet).write(jsxsl)
 
         self.log('JS', '/yelp.js')
-        subprocess.call(['xsltproc',
-                         '-o', os.path.join(self.target_path, 'yelp.js'),
-                         jsxsl, self.get_cache_path()])
+        result = self.get_compiled_xsl(jsxsl)(self._get_cache_tree())
+        with open(os.path.join(self.target_path, 'yelp.js'), 'wb') as fd:
+            fd.write(bytes(result))
 
         if os.path.exists(os.path.join(jspath, 'highlight.pack.js')):
-            self.log('JS', '/highlight.pack.js')
-            shutil.copyfile(os.path.join(jspath, 'highlight.pack.js'),
-                            os.path.join(self.target_path, 'highlight.pack.js'))
+            _copy_js('highlight.pack.js')
 
         if os.path.exists(os.path.join(jspath, 'jquery.syntax.js')):
             for js in ['jquery.syntax.js', 'jquery.syntax.core.js',
                        'jquery.syntax.layout.yelp.js']:
-                self.log('JS', '/' + js)
-                shutil.copyfile(os.path.join(jspath, js),
-                                os.path.join(self.target_path, js))
+                _copy_js(js)
 
             jsxsl = os.path.join(self.tools_path, 'pintail-js-brushes.xsl')
-            fd = open(jsxsl, 'w')
-            fd.writelines([
-                '<xsl:stylesheet',
-                ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"',
-                ' xmlns:mal="http://projectmallard.org/1.0/"',
-                ' xmlns:cache="http://projectmallard.org/cache/1.0/"',
-                ' xmlns:exsl="http://exslt.org/common"',
-                ' xmlns:html="http://www.w3.org/1999/xhtml"',
-                ' extension-element-prefixes="exsl"',
-                ' version="1.0">\n',
-                '<xsl:import href="', xslpath, '/mallard/html/mal2xhtml.xsl"/>\n'
-            ])
-            for xsl in self.get_custom_xsl():
-                fd.write('<xsl:include href="%s"/>\n' % xsl)
-            fd.writelines([
-                '<xsl:output method="text"/>\n',
-                '<xsl:template match="/">\n',
-                '<xsl:for-each select="/cache:cache/mal:page">\n',
-                '<xsl:for-each select="document(@cache:href)//mal:code[@mime]">\n',
-                '  <xsl:variable name="out">\n',
-                '   <xsl:call-template name="mal2html.pre"/>\n',
-                '  </xsl:variable>\n',
-                '  <xsl:variable name="class">\n',
-                '   <xsl:value-of select="exsl:node-set($out)/*/html:pre[last()]/@class"/>\n',
-                '  </xsl:variable>\n',
-                '  <xsl:if test="starts-with($class, ',
-                "'contents syntax brush-'", ')">\n',
-                '   <xsl:text>jquery.syntax.brush.</xsl:text>\n',
-                '   <xsl:value-of select="substring-after($class, ',
-                "'contents syntax brush-'", ')"/>\n',
-                '   <xsl:text>.js&#x000A;</xsl:text>\n',
-                '  </xsl:if>\n',
-                '</xsl:for-each>\n',
-                '</xsl:for-each>\n',
-                '</xsl:template>\n',
-                '</xsl:stylesheet>'
-            ])
-            fd.close()
-
-            brushes = subprocess.check_output(['xsltproc',
-                                               jsxsl, self.get_cache_path()],
-                                              universal_newlines=True)
-            for brush in brushes.split():
-                self.log('JS', '/' + brush)
-                shutil.copyfile(os.path.join(jspath, brush),
-                                os.path.join(self.target_path, brush))
+            includes = ['<xsl:include href="%s"/>\n' % xsl for xsl in self.get_custom_xsl()]
+            with open(jsxsl, 'w') as fd:
+                fd.write(''.join([
+                    '<xsl:stylesheet',
+                    ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"',
+                    ' xmlns:mal="http://projectmallard.org/1.0/"',
+                    ' xmlns:exsl="http://exslt.org/common"',
+                    ' xmlns:html="http://www.w3.org/1999/xhtml"',
+                    ' extension-element-prefixes="exsl"',
+                    ' version="1.0">\n',
+                    '<xsl:import href="', xslpath, '/mallard/html/mal2xhtml.xsl"/>\n',
+                    *includes,
+                    '<xsl:output method="text"/>\n',
+                    '<xsl:template match="/">\n',
+                    '<xsl:for-each select="/mal:page/mal:code">\n',
+                    '  <xsl:variable name="out">\n',
+                    '   <xsl:call-template name="mal2html.pre"/>\n',
+                    '  </xsl:variable>\n',
+                    '  <xsl:variable name="class">\n',
+                    '   <xsl:value-of select="exsl:node-set($out)/*/html:pre[last()]/@class"/>\n',
+                    '  </xsl:variable>\n',
+                    '  <xsl:if test="starts-with($class, ',
+                    "'contents syntax brush-'", ')">\n',
+                    '   <xsl:text>jquery.syntax.brush.</xsl:text>\n',
+                    '   <xsl:value-of select="substring-after($class, ',
+                    "'contents syntax brush-'", ')"/>\n',
+                    '   <xsl:text>.js&#x000A;</xsl:text>\n',
+                    '  </xsl:if>\n',
+                    '</xsl:for-each>\n',
+                    '</xsl:template>\n',
+                    '</xsl:stylesheet>'
+                ]))
+
+            # The brush for a code block only depends on its mime type, so
+            # find each mime type used in the site, and run mal2html.pre once
+            # for each of those instead of for every code block in every page.
+            mimes = set()
+            for page in self._get_cache_tree().iterfind(MAL_NS + 'page'):
+                href = page.get(CACHE_NS + 'href')
+                if href is None:
+                    continue
+                try:
+                    pagetree = etree.parse(href)
+                except (OSError, etree.XMLSyntaxError):
+                    continue
+                for code in pagetree.iter(MAL_NS + 'code'):
+                    mime = code.get('mime')
+                    if mime is not None:
+                        mimes.add(mime)
+            codes = etree.Element(MAL_NS + 'page', nsmap={None: NS_MAP['mal']})
+            for mime in sorted(mimes):
+                etree.SubElement(codes, MAL_NS + 'code', mime=mime)
+
+            brushes = self.get_compiled_xsl(jsxsl)(etree.ElementTree(codes))
+            for brush in str(brushes).split():
+                _copy_js(brush)
+
+        self.copy_files(copies)
 
 
     def build_files(self):
@@ -1583,13 +2198,14 @@ class Site:
 
         The `path` argument is a path as used by `Directory`.
         If it should be ignored, this method returns `True`.
-        Currently, we ignore Pintail's built directory and git's hidden directory.
-        We should be smarter in the future, and perhaps allow a config option.
+        We always ignore Pintail's built directory and git's hidden directory.
+        We also ignore any directories in the `ignore_directories` config option.
+        These may use glob patterns, where `*` can match across slashes.
+        Subdirectories of an ignored directory are ignored as well.
         """
-        if path == '/__pintail__/':
+        if path.startswith(self._ignore_dirs):
             return True
-        # FIXME: use an ignore key in config
-        if path == '/.git/':
+        if self._ignore_re is not None and self._ignore_re.match(path):
             return True
         return False
 
@@ -1601,9 +2217,11 @@ class Site:
         Pintail uses a tag to indicate what kind of thing is happening,
         followed by a data string to show what that thing is happening to.
         """
-        if data.startswith(self.pindir + '/'):
-            data = data[len(os.path.dirname(self.pindir))+1:]
-        self.logger.info('%(tag)-6s %(data)s' % {'tag': tag, 'data': data})
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        if data.startswith(self._log_prefix):
+            data = data[self._log_strip:]
+        self.logger.info('%-6s %s', tag, data)
 
 
     def warn(self, message):
@@ -1624,14 +2242,106 @@ class Site:
 
     @classmethod
     def _makedirs(cls, path):
-        # Python's os.makedirs complains if directory modes don't
-        # match just so. I don't care if they match, as long as I
-        # can write.
-        if os.path.exists(path):
+        # Plugins call this as Site._makedirs(path), without a site to keep
+        # track of what's been made, so just make the directories. Older
+        # versions of Python's os.makedirs complained if directory modes
+        # didn't match just so, so we ignore FileExistsError too.
+        try:
+            os.makedirs(path, exist_ok=True)
+        except FileExistsError:
+            pass
+
+
+    def _ensure_dirs(self, path):
+        # We call this for every media file we copy, usually with the same
+        # few directories over and over. Remember what we've made for this
+        # site so we don't hit the file system each time.
+        # Paths come in both with and without trailing slashes, so normalize
+        # them, and remember every parent too, since those exist now as well.
+        path = os.path.normpath(path)
+        if path in self._made_dirs:
+            return
+        Site._makedirs(path)
+        while path not in self._made_dirs:
+            self._made_dirs.add(path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+
+    def _forget_dirs(self, path):
+        # Call this after removing a directory tree, so _ensure_dirs
+        # doesn't think directories in it still exist.
+        path = os.path.normpath(path)
+        prefix = os.path.join(path, '')
+        self._made_dirs = set(d for d in self._made_dirs
+                              if d != path and not d.startswith(prefix))
+
+
+    @classmethod
+    def _linkfile(cls, src, dst):
+        # Hard link dst to a file we've already copied into the build.
+        # Links can't cross file systems and aren't supported everywhere,
+        # so fall back to a plain copy.
+        try:
+            if os.path.lexists(dst):
+                if os.path.samefile(src, dst):
+                    return
+                os.unlink(dst)
+            os.link(src, dst)
+        except OSError:
+            Site._copyfile(src, dst)
+
+
+    @classmethod
+    def _copyfile(cls, src, dst):
+        # Copy in the kernel where we can, without a trip through Python
+        # buffers. copy_file_range can share blocks on filesystems with
+        # reflinks, but older kernels can't use it across filesystems, so
+        # try sendfile next. Fall back to shutil for anything else.
+        copiers = []
+        if hasattr(os, 'copy_file_range'):
+            def _copy_range(fdin, fdout, offset, count):
+                return os.copy_file_range(fdin, fdout, count, offset, offset)
+            copiers.append(_copy_range)
+        if hasattr(os, 'sendfile'):
+            def _sendfile(fdin, fdout, offset, count):
+                os.lseek(fdout, offset, os.SEEK_SET)
+                return os.sendfile(fdout, fdin, offset, count)
+            copiers.append(_sendfile)
+        if len(copiers) == 0:
+            shutil.copyfile(src, dst)
             return
-        Site._makedirs(os.path.dirname(path))
-        if not os.path.exists(path):
-            os.mkdir(path)
+        with open(src, 'rb') as fsrc:
+            srcstat = os.fstat(fsrc.fileno())
+            # Open the target without truncating it, so we don't clobber
+            # the source if they happen to be the same file.
+            fd = os.open(dst, os.O_WRONLY | os.O_CREAT, 0o666)
+            dststat = os.fstat(fd)
+            if dststat.st_nlink > 1 and not os.path.samestat(srcstat, dststat):
+                # Don't write through a hard link left by an earlier build.
+                os.close(fd)
+                os.unlink(dst)
+                fd = os.open(dst, os.O_WRONLY | os.O_CREAT, 0o666)
+            with open(fd, 'wb') as fdst:
+                if os.path.samestat(srcstat, os.fstat(fd)):
+                    raise shutil.SameFileError('%s and %s are the same file' % (src, dst))
+                fdst.truncate(0)
+                offset = 0
+                for copier in copiers:
+                    try:
+                        while offset < srcstat.st_size:
+                            sent = copier(fsrc.fileno(), fd, offset,
+                                          srcstat.st_size - offset)
+                            if sent == 0:
+                                break
+                            offset += sent
+                    except OSError:
+                        continue
+                    if offset >= srcstat.st_size:
+                        return
+        shutil.copyfile(src, dst)
 
 
 class Config:
@@ -1644,6 +2354,10 @@ class Config:
 
     def __init__(self, site, filename):
         self._site = site
+        # Options are looked up for every directory and page in each build
+        # stage, and the config doesn't change after it's read, so remember
+        # each answer instead of going through ConfigParser again.
+        self._values = {}
         self._config = configparser.ConfigParser()
         self._config.read(filename)
         self._configscr = configparser.ConfigParser()
@@ -1663,6 +2377,11 @@ class Config:
                                  env=site.get_script_env(self),
                                  universal_newlines=True)
             self._configscr.readfp(p.stdout)
+            # The scripts may have looked up options before this was read.
+            self._values.clear()
+        self._dirs = frozenset(d for config in (self._config, self._configscr)
+                               for d in config.sections()
+                               if d.startswith('/') and d.endswith('/'))
 
 
     def get(self, key, path=None):
@@ -1676,6 +2395,16 @@ class Config:
         """
         if path is None:
             path = 'pintail'
+        try:
+            return self._values[(key, path)]
+        except KeyError:
+            pass
+        ret = self._get(key, path)
+        self._values[(key, path)] = ret
+        return ret
+
+
+    def _get(self, key, path):
         if self._site._local and path == 'pintail':
             ret = self._configscr.get('local', key, fallback=None)
             if ret is not None:
@@ -22,9 +22,17 @@ class TranslationProvider(pintail.site.Extendable):
     """
     An extension point to provide translations for the site.
     """
+
+    # Subclasses that don't declare __slots__ still get a __dict__
+    # for their own attributes.
+    __slots__ = ('site', '_source_lang', '_langs', '_langs_set', '_lang_dirs')
+
     def __init__(self, site):
         self.site = site
+        self._source_lang = None
         self._langs = None
+        self._langs_set = None
+        self._lang_dirs = None
 
 
     def get_source_lang(self):
@@ -34,7 +42,9 @@ class TranslationProvider(pintail.site.Extendable):
         By default, this uses the `source_lang` config option, or `en` if that isn't present.
         Different translation providers could have a different behavior.
         """
-        return self.site.config.get('source_lang') or 'en'
+        if self._source_lang is None:
+            self._source_lang = self.site.config.get('source_lang') or 'en'
+        return self._source_lang
 
 
     def get_site_langs(self):
@@ -46,14 +56,49 @@ class TranslationProvider(pintail.site.Extendable):
         """
         if self._langs is not None:
             return self._langs
-        self._langs = []
+        # Keep the list in the order languages are found, so builds are
+        # repeatable, but check for duplicates with a set. Also note which
+        # directories each language is used in for directory_supports.
+        langs = []
+        lang_dirs = {}
         for directory in self.site.root.iter_directories():
-            for lang in self.get_directory_langs(directory):
-                if lang not in self._langs:
-                    self._langs.append(lang)
+            for lang in directory.get_langs():
+                if lang not in lang_dirs:
+                    lang_dirs[lang] = set()
+                    langs.append(lang)
+                lang_dirs[lang].add(directory.path)
+        self._langs = langs
+        self._langs_set = frozenset(lang_dirs)
+        self._lang_dirs = {lang: frozenset(lang_dirs[lang]) for lang in lang_dirs}
         return self._langs
 
 
+    def get_site_langs_set(self):
+        """
+        Get all languages used throughout the site as a frozenset.
+
+        This has the same languages as `get_site_langs`, for callers that
+        need to check whether a language is used rather than list them.
+        """
+        self.get_site_langs()
+        return self._langs_set
+
+
+    def directory_supports(self, directory, lang):
+        """
+        Get whether a directory is translated into a language.
+
+        This is true if `get_directory_langs` includes the language for the
+        directory. Pintail uses this to avoid asking for translations of pages
+        in directories that aren't translated into a language at all.
+        """
+        self.get_site_langs()
+        if self._lang_dirs is None:
+            return lang in directory.get_langs()
+        dirs = self._lang_dirs.get(lang)
+        return dirs is not None and directory.path in dirs
+
+
     def get_directory_langs(self, directory):
         """
         Get all languages available for a single directory.
@@ -104,3 +149,30 @@ class TranslationProvider(pintail.site.Extendable):
         Translation providers should override this method.
         """
         return False
+
+
+    def translate_pages(self, pages, lang):
+        """
+        Translate a list of pages into a language and return which were translated.
+
+        This returns a dict mapping each page to whether it was translated.
+        By default, this just calls `translate_page` on each page. Translation
+        providers that have to start a tool or make a request for each page
+        can override this to translate many pages at once. Pintail only calls
+        this method ahead of time if a translation provider overrides it.
+        """
+        return {page: self.translate_page(page, lang) for page in pages}
+
+
+    def translate_media_batch(self, items, lang):
+        """
+        Translate a list of media files into a language and return which were translated.
+
+        The `items` argument is a list of `(source, mediafile)` tuples, like the
+        arguments to `translate_media`. This returns a dict mapping each tuple to
+        whether that file was translated. By default, this just calls
+        `translate_media` on each file. Translation providers can override this
+        to translate many files at once.
+        """
+        return {(source, mediafile): self.translate_media(source, mediafile, lang)
+                for source, mediafile in items}
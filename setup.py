@@ -2,8 +2,8 @@ from setuptools import setup
 
 import sys
 
-if sys.version_info[0] != 3:
-    sys.stderr.write("pintail requires python 3\n")
+if sys.version_info < (3, 9):
+    sys.stderr.write("pintail requires python 3.9 or later\n")
     sys.exit(1)
 
 try:
@@ -20,8 +20,10 @@ setup(
     packages=['pintail'],
     namespace_packages=['pintail'],
     scripts=['bin/pintail'],
+    python_requires='>=3.9',
+    include_package_data=True,
     package_data={
-        'pintail': ['sample.cfg', 'pintail-atom.xsl', 'pintail-html.xsl'],
+        'pintail': ['*.cfg', '*.xsl'],
     },
     author='Shaun McCance',
     author_email='shaunm@gnome.org',
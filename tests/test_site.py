@@ -0,0 +1,105 @@
+# pintail - Build static sites from collections of Mallard documents
+# Copyright (c) 2015 Shaun McCance <shaunm@gnome.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from lxml import etree
+
+import pintail.site
+
+MAL_NS = '{http://projectmallard.org/1.0/}'
+CACHE_NS = '{http://projectmallard.org/cache/1.0/}'
+SITE_NS = '{http://projectmallard.org/site/1.0/}'
+
+
+class MakeDirsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        cfgfile = os.path.join(self.tmpdir, 'pintail.cfg')
+        with open(cfgfile, 'w') as fd:
+            fd.write('[pintail]\n')
+        self.cfgfile = cfgfile
+
+    def test_makedirs_class_call(self):
+        # Plugins call this on the class, without a site.
+        path = os.path.join(self.tmpdir, 'a', 'b', 'c')
+        pintail.site.Site._makedirs(path)
+        self.assertTrue(os.path.isdir(path))
+        pintail.site.Site._makedirs(path)
+        self.assertTrue(os.path.isdir(path))
+
+    def test_ensure_dirs_per_site(self):
+        path = os.path.join(self.tmpdir, 'a', 'b')
+        site = pintail.site.Site(self.cfgfile)
+        site._ensure_dirs(path)
+        self.assertTrue(os.path.isdir(path))
+        shutil.rmtree(os.path.join(self.tmpdir, 'a'))
+        other = pintail.site.Site(self.cfgfile)
+        other._ensure_dirs(path)
+        self.assertTrue(os.path.isdir(path))
+
+
+class CacheDataTest(unittest.TestCase):
+    def write_cache(self, page):
+        out = io.BytesIO()
+        with etree.xmlfile(out, encoding='utf-8') as xf:
+            with xf.element(CACHE_NS + 'cache', nsmap=pintail.site.CACHE_NSMAP):
+                pintail.site._write_cache_data(xf, page)
+        return out.getvalue()
+
+    def make_page(self):
+        page = etree.Element(MAL_NS + 'page', nsmap=pintail.site.CACHE_NSMAP)
+        page.set('id', '/index')
+        page.set(SITE_NS + 'dir', '/')
+        page.set(CACHE_NS + 'href', '/index.page')
+        info = etree.SubElement(page, MAL_NS + 'info')
+        etree.SubElement(info, MAL_NS + 'link', type='guide', xref='/sub/a')
+        title = etree.SubElement(page, MAL_NS + 'title')
+        title.text = 'Index & more'
+        section = etree.Element(MAL_NS + 'section')
+        section.set(SITE_NS + 'dir', '/')
+        page.append(section)
+        return page
+
+    def test_no_redundant_namespaces(self):
+        page = self.make_page()
+        data = self.write_cache(page)
+        # Only the cache element declares namespaces.
+        start = data.index(b'<page')
+        self.assertNotIn(b'xmlns', data[start:])
+        cache = etree.fromstring(data)
+        def _items(elem):
+            return [(e.tag, dict(e.attrib), e.text) for e in elem.iter()]
+        self.assertEqual(_items(cache[0]), _items(page))
+
+    def test_new_namespaces_declared(self):
+        page = self.make_page()
+        etree.SubElement(page[0], '{http://projectmallard.org/ui/1.0/}thumb',
+                         nsmap={'ui': 'http://projectmallard.org/ui/1.0/'})
+        data = self.write_cache(page)
+        start = data.index(b'<page')
+        self.assertEqual(data[start:].count(b'xmlns'), 1)
+        cache = etree.fromstring(data)
+        self.assertEqual(cache[0][0][1].tag, '{http://projectmallard.org/ui/1.0/}thumb')
+
+
+if __name__ == '__main__':
+    unittest.main()